@@ -0,0 +1,41 @@
+import argparse
+
+from commu.midi_generator.generation_budget import compute_tokens_per_bar, write_tokens_per_bar
+from commu.model.config_helper import get_default_cfg_inference
+
+
+def main(args: argparse.Namespace) -> None:
+    tokens_per_bar = compute_tokens_per_bar(args.input_npy, args.target_npy, quantile=args.quantile)
+    write_tokens_per_bar(tokens_per_bar, args.output)
+    for role, values in sorted(tokens_per_bar.items()):
+        print(role, values)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='tokens per bar of the preprocessed training data, read by the generation budget')
+    parser.add_argument(
+        '--input_npy',
+        dest='input_npy',
+        type=str,
+        required=True,
+        help='input_train.npy written by the preprocessor')
+    parser.add_argument(
+        '--target_npy',
+        dest='target_npy',
+        type=str,
+        required=True,
+        help='target_train.npy written by the preprocessor')
+    parser.add_argument(
+        '--output',
+        dest='output',
+        type=str,
+        default=get_default_cfg_inference().GENERATION.tokens_per_bar_fp)
+    parser.add_argument(
+        '--quantile',
+        dest='quantile',
+        type=float,
+        default=0.99)
+    args = parser.parse_args()
+
+    main(args)
@@ -1,21 +1,36 @@
 import json
 from fractions import Fraction
 from pathlib import Path
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 
 from pydantic import BaseModel, validator
 
-from commu.preprocessor.encoder import encoder_utils, TOKEN_OFFSET
+from commu.preprocessor.encoder import encoder_utils, get_vocabulary, TOKEN_OFFSET
 from commu.preprocessor.utils import constants
 from commu.preprocessor.utils.container import MidiMeta
 
 
 class ModelArguments(BaseModel):
     checkpoint_dir: str
+    # dynamic int8 linear layers, CPU only
+    quantize: bool = False
+    # bf16 weights and memory, logits upcast to fp32, CPUs with native bf16 only
+    bfloat16: bool = False
+    # traced single-token decode step, cached next to the checkpoint
+    compile_decode_step: bool = False
+    # "torch" or "onnxruntime" (CPU only, graphs exported next to the checkpoint)
+    backend: str = "torch"
+
+    @validator("backend")
+    def validate_backend(cls, value: str) -> str:
+        if value not in ("torch", "onnxruntime"):
+            raise ValueError(f"backend must be torch or onnxruntime, received: {value}")
+        return value
 
 
 class TransXlInputData(MidiMeta):
-    output_dir: Path
+    # only needed by `PostprocessTask.execute`, which writes the midi files
+    output_dir: Optional[Path] = None
 
     num_generate: int
     top_k: int
@@ -35,9 +50,7 @@ class TransXlInputData(MidiMeta):
 
     @property
     def chord_token_components(self) -> Dict[str, list]:
-        event2word, _ = encoder_utils.mk_remi_map()
-        event2word = encoder_utils.add_flat_chord2map(event2word)
-        event2word = encoder_utils.abstract_chord_types(event2word)
+        event2word = get_vocabulary().event2word
 
         beats_per_bar = int(Fraction(self.time_signature) * 4)
         chord_idx_lst, unique_cp = encoder_utils.detect_chord(self.chord_progression, beats_per_bar)
@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import enum
+from typing import TYPE_CHECKING, Optional, Union
+
+import numpy as np
+
+from commu.preprocessor.encoder import TOKEN_OFFSET
+from commu.preprocessor.utils.constants import DEFAULT_POSITION_RESOLUTION
+
+if TYPE_CHECKING:
+    import torch
+
+
+class GrammarState(enum.IntEnum):
+    """
+    state of the event grammar, given by the class of the last token
+    """
+    META = 0
+    BAR = 1
+    POSITION = 2
+    NOTE_VELOCITY = 3
+    PITCH = 4
+    NOTE_DURATION = 5
+    CHORD = 6
+    EOS = 7
+
+
+TOKEN_RANGES = {
+    GrammarState.EOS: (TOKEN_OFFSET.EOS.value, TOKEN_OFFSET.BAR.value),
+    GrammarState.BAR: (TOKEN_OFFSET.BAR.value, TOKEN_OFFSET.PITCH.value),
+    GrammarState.PITCH: (TOKEN_OFFSET.PITCH.value, TOKEN_OFFSET.NOTE_VELOCITY.value),
+    GrammarState.NOTE_VELOCITY: (TOKEN_OFFSET.NOTE_VELOCITY.value, TOKEN_OFFSET.CHORD_START.value),
+    GrammarState.CHORD: (TOKEN_OFFSET.CHORD_START.value, TOKEN_OFFSET.CHORD_END.value + 1),
+    GrammarState.NOTE_DURATION: (TOKEN_OFFSET.NOTE_DURATION.value, TOKEN_OFFSET.POSITION.value),
+    GrammarState.POSITION: (
+        TOKEN_OFFSET.POSITION.value, TOKEN_OFFSET.POSITION.value + DEFAULT_POSITION_RESOLUTION
+    ),
+}
+
+# token classes that may be sampled in each state
+# chords are always teacher forced, so they are never sampled
+TRANSITIONS = {
+    GrammarState.META: [GrammarState.BAR],
+    GrammarState.BAR: [GrammarState.POSITION, GrammarState.BAR],
+    GrammarState.POSITION: [GrammarState.NOTE_VELOCITY],
+    GrammarState.NOTE_VELOCITY: [GrammarState.PITCH],
+    GrammarState.PITCH: [GrammarState.NOTE_DURATION],
+    GrammarState.NOTE_DURATION: [GrammarState.POSITION, GrammarState.BAR, GrammarState.EOS],
+    GrammarState.CHORD: [GrammarState.POSITION, GrammarState.BAR, GrammarState.EOS],
+    GrammarState.EOS: [],
+}
+
+
+class EventGrammar:
+    """
+    finite-state grammar of the REMI note events
+    (Bar -> Position -> Note Velocity -> Note On -> Note Duration)
+
+    the allowed-token mask of every state is precomputed, together with the
+    teacher forcing rule on EOS: EOS is banned while chords remain to be written
+    bar tokens stay allowed once none remain, the teacher forcing turns them into EOS
+    """
+    def __init__(self, device: Optional[torch.device] = None):
+        """
+        the masks are tensors on `device`, or numpy arrays without it (onnxruntime backend)
+        """
+        vocab_size = TOKEN_OFFSET.VOCAB_SIZE.value
+
+        self.token_to_state = np.full(vocab_size, GrammarState.META, dtype=np.int64)
+        for state, (start, end) in TOKEN_RANGES.items():
+            self.token_to_state[start:end] = state
+
+        masks = np.zeros((len(GrammarState), 2, vocab_size), dtype=bool)
+        for state, next_states in TRANSITIONS.items():
+            for next_state in next_states:
+                start, end = TOKEN_RANGES[next_state]
+                masks[state, :, start:end] = True
+        # [:, 0] no remnant chord, [:, 1] chords remain
+        masks[:, 1, TOKEN_OFFSET.EOS.value] = False
+        self.masks = masks
+        if device is not None:
+            import torch
+
+            self.masks = torch.from_numpy(masks).to(device)
+
+    def get_state(self, token: int) -> GrammarState:
+        return GrammarState(self.token_to_state[token])
+
+    def allowed_tokens(
+        self, last_token: int, has_remnant_chord: bool
+    ) -> Union[torch.Tensor, np.ndarray]:
+        """
+        returns :: [vocab] mask of the tokens allowed after `last_token`
+        """
+        return self.masks[self.token_to_state[last_token], int(has_remnant_chord)]
+
+    def mask_logits(
+        self, logits: Union[torch.Tensor, np.ndarray], last_token: int, has_remnant_chord: bool
+    ) -> Union[torch.Tensor, np.ndarray]:
+        """
+        logits :: [vocab - 1], without the padding token
+        """
+        allowed = self.allowed_tokens(last_token, has_remnant_chord)[1:]
+        if isinstance(logits, np.ndarray):
+            return np.where(allowed, logits, logits.dtype.type(-np.inf))
+        return logits.masked_fill(~allowed, float("-inf"))
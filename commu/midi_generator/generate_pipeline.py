@@ -1,17 +1,33 @@
-import torch
+from __future__ import annotations
+
+import io
+from typing import TYPE_CHECKING, Dict, Union
+
+import yacs.config
 
 from commu.midi_generator.container import ModelArguments
 from commu.midi_generator.model_initializer import ModelInitializeTask
 from commu.midi_generator.info_preprocessor import PreprocessTask
 from commu.midi_generator.midi_inferrer import InferenceTask
+from commu.midi_generator.onnx_runtime import OnnxRuntimeDecoder
 from commu.midi_generator.sequence_postprocessor import PostprocessTask
 
+if TYPE_CHECKING:
+    from commu.model.model import MemTransformerLM
+
 
 class MidiGenerationPipeline:
     def __init__(self, model_arguments: dict):
-        self.map_location = "cuda" if torch.cuda.is_available() else "cpu"
-        self.device = torch.device(self.map_location)
         self.model_args = ModelArguments(**model_arguments)
+        if self.model_args.backend == "onnxruntime":
+            # onnxruntime runs on the cpu and never imports torch
+            self.map_location = "cpu"
+            self.device = None
+        else:
+            import torch
+
+            self.map_location = "cuda" if torch.cuda.is_available() else "cpu"
+            self.device = torch.device(self.map_location)
 
         self.model_initialize_task = ModelInitializeTask(
             model_args=self.model_args,
@@ -20,4 +36,38 @@ class MidiGenerationPipeline:
         )
         self.preprocess_task = PreprocessTask()
         self.inference_task = InferenceTask(self.device)
-        self.postprocess_task = PostprocessTask()
\ No newline at end of file
+        self.postprocess_task = PostprocessTask()
+
+    def execute_multi_role_in_memory(
+            self,
+            model: Union[MemTransformerLM, OnnxRuntimeDecoder],
+            inference_cfg: yacs.config.CfgNode,
+            role_to_input_data: Dict[str, dict],
+    ) -> Dict[str, io.BytesIO]:
+        """
+        generate one midi per track role, decoding every role as a row of a single batch
+        returns the midi of each role in a byte buffer, nothing is written to disk
+        """
+        role_to_preprocess_task = {}
+        encoded_metas = []
+        for role, input_data in role_to_input_data.items():
+            preprocess_task = PreprocessTask()
+            encoded_metas.append(preprocess_task.excecute(input_data))
+            role_to_preprocess_task[role] = preprocess_task
+        input_datas = [task.input_data for task in role_to_preprocess_task.values()]
+
+        self.inference_task(
+            model=model,
+            input_data=None,
+            inference_cfg=inference_cfg,
+            decode_step=self.model_initialize_task.decode_step,
+        )
+        sequences = self.inference_task.execute_batch(encoded_metas, input_datas)
+
+        role_to_buffer = {}
+        for (role, preprocess_task), seq in zip(role_to_preprocess_task.items(), sequences):
+            self.postprocess_task(input_data=preprocess_task.input_data)
+            role_to_buffer[role] = self.postprocess_task.execute_in_memory(
+                sequences=[seq], meta_info_len=preprocess_task.get_meta_info_length()
+            )[0]
+        return role_to_buffer
@@ -0,0 +1,98 @@
+import functools
+import math
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, NamedTuple, Optional, Union
+
+import numpy as np
+import yaml
+
+from commu.midi_generator.container import TransXlInputData
+from commu.preprocessor.encoder import TOKEN_OFFSET
+from commu.preprocessor.encoder.meta import META_ENCODING_ORDER, Offset
+from commu.preprocessor.utils import constants
+
+TokensPerBar = Dict[str, Dict[str, float]]
+
+class GenerationBudget(NamedTuple):
+    # loop steps of a sequence before it is cut
+    num_steps: int
+    # positions allocated for the memory of a sequence
+    memory_length: int
+
+
+def compute_tokens_per_bar(
+    input_npy_fp: Union[str, Path], target_npy_fp: Union[str, Path], quantile: float = 0.99
+) -> TokensPerBar:
+    """
+    tokens per bar of the training samples (`input_*.npy` / `target_*.npy` written by the preprocessor)
+    by track role and time signature, taken at `quantile` over the samples
+    """
+    inputs = np.load(str(input_npy_fp), allow_pickle=True)
+    targets = np.load(str(target_npy_fp), allow_pickle=True)
+    role_idx = META_ENCODING_ORDER.index("track_role")
+    time_signature_idx = META_ENCODING_ORDER.index("time_signature")
+    role_map = {token + Offset.TRACK_ROLE.value: role for role, token in constants.TRACK_ROLE_MAP.items()}
+    time_signature_map = {
+        token + Offset.TIME_SIGNATURE.value: time_signature
+        for time_signature, token in constants.TIME_SIG_MAP.items()
+    }
+
+    samples = defaultdict(list)
+    for meta, events in zip(inputs, targets):
+        role = role_map.get(int(meta[role_idx]))
+        time_signature = time_signature_map.get(int(meta[time_signature_idx]))
+        num_bars = int(np.count_nonzero(np.asarray(events) == TOKEN_OFFSET.BAR.value))
+        if role is None or time_signature is None or num_bars == 0:
+            continue
+        samples[role, time_signature].append(len(events) / num_bars)
+
+    tokens_per_bar = defaultdict(dict)
+    for (role, time_signature), values in samples.items():
+        tokens_per_bar[role][time_signature] = float(np.quantile(values, quantile))
+    return dict(tokens_per_bar)
+
+
+def write_tokens_per_bar(tokens_per_bar: TokensPerBar, fp: Union[str, Path]) -> None:
+    with open(fp, "w") as f:
+        yaml.safe_dump(tokens_per_bar, f)
+
+
+@functools.lru_cache(maxsize=None)
+def load_tokens_per_bar(fp: str) -> TokensPerBar:
+    """
+    statistics written by `write_tokens_per_bar`, empty when the file is not built
+    """
+    if not fp or not Path(fp).exists():
+        return {}
+    with open(fp) as f:
+        return yaml.safe_load(f) or {}
+
+
+def get_tokens_per_bar(tokens_per_bar: TokensPerBar, track_role: str, time_signature: str) -> Optional[float]:
+    return tokens_per_bar.get(track_role, {}).get(time_signature)
+
+
+def compute_generation_budget(
+    input_data: TransXlInputData,
+    num_conditional_tokens: int,
+    tokens_per_bar: TokensPerBar,
+    max_steps: int,
+    max_memory_length: int,
+    margin: float = 1.25,
+) -> GenerationBudget:
+    """
+    step budget and memory length of a sequence from its number of measures, time signature and role,
+    bounded by `max_steps` (`generation_length`) and `max_memory_length` (`memory_length`)
+    the sequences without measured statistics keep the whole `max_steps`
+    """
+    num_bars = int(math.ceil(input_data.num_measures))
+    bar_tokens = get_tokens_per_bar(tokens_per_bar, input_data.track_role, input_data.time_signature)
+    if bar_tokens is None:
+        num_steps = max_steps
+    else:
+        # one more step for the EOS token
+        num_steps = min(int(math.ceil(num_bars * bar_tokens * margin)) + 1, max_steps)
+    # a step feeds at most two tokens, since the last forced token is fed twice
+    memory_length = min(num_conditional_tokens + 2 * num_steps, max_memory_length)
+    return GenerationBudget(num_steps, memory_length)
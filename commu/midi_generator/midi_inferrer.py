@@ -1,37 +1,99 @@
-import math
-from typing import List, Tuple
+from __future__ import annotations
 
+import contextlib
+import copy
+import math
+import weakref
+from collections import OrderedDict, deque
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    ContextManager,
+    Dict,
+    Generator,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
+
+import miditoolkit
 import numpy as np
-import torch
-import torch.nn.functional as F
 import yacs.config
 
 from commu.logger import logger
 from commu.midi_generator.container import TransXlInputData
-from commu.model.model import MemTransformerLM
+from commu.midi_generator.event_grammar import EventGrammar
+from commu.midi_generator.generation_budget import (
+    GenerationBudget,
+    compute_generation_budget,
+    load_tokens_per_bar,
+)
+from commu.midi_generator.note_stream import NoteStream
+from commu.midi_generator.onnx_runtime import OnnxRuntimeDecoder
+from commu.midi_generator.sampler import sample_tokens, sample_tokens_numpy
 from commu.preprocessor.encoder import TOKEN_OFFSET
 from commu.preprocessor.utils.constants import DEFAULT_POSITION_RESOLUTION
 
+# the onnxruntime backend runs without torch, which only the torch backend imports
+if TYPE_CHECKING:
+    import torch
+
+    from commu.model.decode_step import CompiledDecodeStep
+    from commu.model.model import IncrementalMems, MemTransformerLM
+
 
 class TeacherForceTask:
     def __init__(self, input_data):
         self.input_data = input_data
-        self.next_tokens_forced = []
+        self.next_tokens_forced = deque()
         self.wrong_tokens = []
         self.no_sequence_appended = False
         self.is_incomplete = input_data.num_measures % 4 != 0
         self.incomplete_filled = not self.is_incomplete
+        # running count of the bar tokens in the sequence, updated by `observe_token`
+        self.num_bars = 0
 
-        self.chord_token, self.chord_position = input_data.chord_token_components.values()
-        assert len(self.chord_token) == len(self.chord_position), "Wrong Chord Length"
+        chord_token, chord_position = input_data.chord_token_components.values()
+        assert len(chord_token) == len(chord_position), "Wrong Chord Length"
+        self.chord_token = deque(chord_token)
+        self.chord_position = deque(chord_position)
         self.chord_length = len(self.chord_token)
-        self.inter_chord_flags = []
+        self.inter_chord_flags = deque()
         for i in self.chord_position:
             if i == TOKEN_OFFSET.POSITION.value:
                 self.inter_chord_flags.append(False)
             else:
                 self.inter_chord_flags.append(True)
 
+    def get_state(self) -> Dict[str, Any]:
+        """
+        copy of the state changed while decoding, restored by `set_state`
+        """
+        return {
+            "next_tokens_forced": copy.copy(self.next_tokens_forced),
+            "wrong_tokens": copy.copy(self.wrong_tokens),
+            "no_sequence_appended": self.no_sequence_appended,
+            "incomplete_filled": self.incomplete_filled,
+            "num_bars": self.num_bars,
+            "chord_token": copy.copy(self.chord_token),
+            "chord_position": copy.copy(self.chord_position),
+            "inter_chord_flags": copy.copy(self.inter_chord_flags),
+        }
+
+    def set_state(self, state: Dict[str, Any]) -> None:
+        for name, value in state.items():
+            setattr(self, name, copy.copy(value))
+
+    def observe_token(self, token: int) -> None:
+        """
+        update the running state with a token appended to the sequence
+        """
+        if token == TOKEN_OFFSET.BAR.value:
+            self.num_bars += 1
+
     def check_first_position(self, seq):
         """
         check if it's a token following a bar token
@@ -120,10 +182,10 @@ class TeacherForceTask:
         self.next_tokens_forced.append(int(TOKEN_OFFSET.POSITION.value))
 
     def teach_chord_token(self):
-        next_chord_tokens = self.chord_token.pop(0)
+        next_chord_tokens = self.chord_token.popleft()
         self.next_tokens_forced.append(next_chord_tokens)
-        self.chord_position.pop(0)
-        self.inter_chord_flags.pop(0)
+        self.chord_position.popleft()
+        self.inter_chord_flags.popleft()
         self.wrong_tokens = []
 
     def teach_chord_position(self):
@@ -169,155 +231,567 @@ class TeacherForceTask:
             logger.info(seq)
 
 
+class RowSnapshot(NamedTuple):
+    seq_len: int
+    num_fed: int
+    num_steps: int
+    teacher_state: Dict[str, Any]
+
+
+class StreamEvent(NamedTuple):
+    """
+    event of `InferenceTask.stream_batch` about the sequence `idx`, whose generated
+    tokens and notes are the first `num_tokens` and `num_notes` after the event
+        "tokens": `tokens` were appended and completed `notes`
+        "rollback": the sequence went back to its last bar, later tokens and notes are discarded
+        "restart": the sequence failed and is generated again from scratch
+        "finished": the sequence is complete, `seq` holds it
+    """
+    kind: str
+    idx: int
+    num_tokens: int
+    num_notes: int
+    tokens: List[int]
+    notes: List[miditoolkit.Note]
+    seq: Optional[List[int]] = None
+
+
+class DecodingRow:
+    """
+    state of one sequence decoded as a row of the batch
+    """
+    def __init__(self, seq: List[int], teacher: TeacherForceTask, budget: GenerationBudget):
+        self.seq = seq
+        self.teacher = teacher
+        self.budget = budget
+        self.logits = None
+        self.next_tokens = []
+        self.num_steps = 0
+        self.failed = False
+        # tokens fed to the memory after the prefilled conditioning,
+        # which differs from `seq` since the last meta token is not kept and forced tokens are fed twice
+        self.num_conditional_tokens = len(seq)
+        self.fed_tokens = []
+        self.snapshot = None
+        self.num_rollbacks = 0
+        for token in seq:
+            teacher.observe_token(token)
+
+    def append(self, token: int) -> None:
+        self.seq.append(token)
+        self.teacher.observe_token(token)
+
+    def get_context(self) -> List[int]:
+        """
+        every token held by the memory, in the order it was fed
+        """
+        return self.seq[:self.num_conditional_tokens - 1] + self.fed_tokens
+
+    def take_snapshot(self) -> None:
+        self.snapshot = RowSnapshot(
+            len(self.seq), len(self.fed_tokens), self.num_steps, self.teacher.get_state()
+        )
+
+    def roll_back(self) -> None:
+        """
+        go back to the state of the last snapshot, the memory has to be prefilled again
+        """
+        del self.seq[self.snapshot.seq_len:]
+        del self.fed_tokens[self.snapshot.num_fed:]
+        self.num_steps = self.snapshot.num_steps
+        self.teacher.set_state(self.snapshot.teacher_state)
+        self.logits = None
+        self.next_tokens = []
+        self.failed = False
+        self.num_rollbacks += 1
+
+
+class PrefixStateCache:
+    """
+    LRU cache of the memory prefilled from an encoded meta, bounded by a byte budget
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self._states = OrderedDict()
+
+    def __len__(self):
+        return len(self._states)
+
+    @staticmethod
+    def state_bytes(state: List[torch.Tensor]) -> int:
+        # tensors of the torch backend, arrays of the onnxruntime one
+        return sum(t.nbytes for t in state)
+
+    def get(self, key: Tuple[int, ...]) -> Optional[List[torch.Tensor]]:
+        state = self._states.get(key)
+        if state is not None:
+            self._states.move_to_end(key)
+        return state
+
+    def put(self, key: Tuple[int, ...], state: List[torch.Tensor]) -> None:
+        if key in self._states:
+            self.num_bytes -= self.state_bytes(self._states.pop(key))
+        size = self.state_bytes(state)
+        if size > self.max_bytes:
+            return
+        self._states[key] = state
+        self.num_bytes += size
+        self.evict()
+
+    def evict(self) -> None:
+        while self.num_bytes > self.max_bytes:
+            _, state = self._states.popitem(last=False)
+            self.num_bytes -= self.state_bytes(state)
+
+
+# one cache per model, living as long as the model does
+_PREFIX_STATE_CACHES = weakref.WeakKeyDictionary()
+
+
+def get_prefix_state_cache(model: MemTransformerLM, max_bytes: int) -> PrefixStateCache:
+    cache = _PREFIX_STATE_CACHES.get(model)
+    if cache is None:
+        cache = PrefixStateCache(max_bytes)
+        _PREFIX_STATE_CACHES[model] = cache
+    elif cache.max_bytes != max_bytes:
+        cache.max_bytes = max_bytes
+        cache.evict()
+    return cache
+
+
 class InferenceTask:
-    def __init__(self, device: torch.device):
+    def __init__(self, device: Optional[torch.device]):
+        """
+        `device` of the torch backend, None when only the onnxruntime one is used
+        """
         self.device = device
 
     def __call__(
         self,
-        model: MemTransformerLM,
-        input_data: TransXlInputData,
+        model: Union[MemTransformerLM, OnnxRuntimeDecoder],
+        input_data: Optional[TransXlInputData],
         inference_cfg: yacs.config.CfgNode,
+        decode_step: Optional[CompiledDecodeStep] = None,
     ):
+        """
+        `decode_step` is the traced single-token step of `model`, used when given
+        """
         self.model = model
         self.input_data = input_data
         self.inference_cfg = inference_cfg
+        self.retry_counts = {"rollbacks": 0, "restarts": 0}
+        self.onnx_decoder = model if isinstance(model, OnnxRuntimeDecoder) else None
+        self.decode_step = decode_step
+        self.grammar = None
+        if inference_cfg.GENERATION.get("constrain_grammar", True):
+            # onnxruntime logits are numpy arrays
+            self.grammar = EventGrammar(None if self.onnx_decoder is not None else self.device)
+        self.tokens_per_bar = load_tokens_per_bar(
+            inference_cfg.GENERATION.get("tokens_per_bar_fp", "")
+        )
+
+    def get_budget(
+        self, input_data: TransXlInputData, num_conditional_tokens: int
+    ) -> GenerationBudget:
+        return compute_generation_budget(
+            input_data,
+            num_conditional_tokens,
+            self.tokens_per_bar,
+            self.inference_cfg.GENERATION.generation_length,
+            self.inference_cfg.MODEL.memory_length,
+        )
+
+    def no_grad(self) -> ContextManager:
+        """
+        context of the decoding, gradients are disabled on the torch backend
+        """
+        if self.onnx_decoder is not None:
+            return contextlib.nullcontext()
+        import torch
+
+        return torch.no_grad()
+
+    def init_mems(self, capacity: Optional[int] = None) -> IncrementalMems:
+        """
+        empty memory whose buffers are allocated for `capacity` positions
+        """
+        if self.onnx_decoder is not None:
+            return self.onnx_decoder.init_mems(capacity)
+        return self.model.init_incremental_mems(capacity)
+
+    def forward_tokens(
+        self, ctx: np.ndarray, mems: IncrementalMems, return_logits: bool = True
+    ) -> Tuple[Optional[Union[torch.Tensor, np.ndarray]], IncrementalMems]:
+        """
+        feed `ctx` :: [len x bsz] after `mems`, which prefills an empty memory
+        returns the logits after the last token :: [bsz x vocab - 1] (None without `return_logits`),
+        a tensor on the torch backend and an array on the onnxruntime one
+        """
+        if self.onnx_decoder is not None:
+            logits, mems = self.onnx_decoder.forward(ctx, mems)
+            return logits[:, 1:] if return_logits else None, mems
+        import torch
+
+        input_token = torch.from_numpy(ctx).to(self.device).type(torch.long)
+        if self.decode_step is not None and input_token.size(0) == 1:
+            # the traced step runs single tokens whenever the memory fits its buffers
+            all_logits = self.decode_step(input_token, mems)
+            if all_logits is not None:
+                return all_logits[-1, :, 1:].float(), mems
+        logits, mems = self.model.prefill(input_token, mems, return_logits=return_logits)
+        if not return_logits:
+            return None, mems
+        # a bf16 model is sampled from fp32 logits
+        return logits[:, 1:].float(), mems
 
     def init_seq_and_mems(
         self, encoded_meta: List[int], num_conditional_tokens: int
-    ) -> Tuple[List[int], torch.Tensor]:
+    ) -> Tuple[List[int], IncrementalMems]:
+        init_seqs, init_mems = self.init_seqs_and_mems([encoded_meta[:num_conditional_tokens]])
+        return init_seqs[0], init_mems
 
+    def init_seqs_and_mems(
+        self,
+        encoded_metas: List[List[int]],
+        input_datas: Optional[List[TransXlInputData]] = None,
+    ) -> Tuple[List[List[int]], IncrementalMems]:
+        """
+        prefill the conditioning of every row, encoded metas share the same length
+        the prefill runs once per distinct encoded meta not found in the prefix state cache
+        and the memory is allocated for the longest generation budget of the rows
+        """
+        if input_datas is None:
+            input_datas = [self.input_data] * len(encoded_metas)
         seq = [0]
-        ctx = np.array(seq + encoded_meta[: num_conditional_tokens - 1], dtype=np.int32)[
-            :, np.newaxis
-        ]
-        context = torch.from_numpy(ctx).to(self.device).type(torch.long)
-        _, init_mems = self.model.forward_generate(context, mems=None)
-        init_seq = seq + encoded_meta[:num_conditional_tokens]
-        return init_seq, init_mems
+        cache = get_prefix_state_cache(
+            self.model, self.inference_cfg.GENERATION.get("prefix_cache_bytes", 0)
+        )
+        keys = [tuple(encoded_meta) for encoded_meta in encoded_metas]
+        states = {key: cache.get(key) for key in keys}
+        missing = [key for key, state in states.items() if state is None]
+        if missing:
+            ctx = np.array([seq + list(key[:-1]) for key in missing], dtype=np.int32).T
+            _, prefilled = self.forward_tokens(ctx, self.init_mems(len(ctx)), return_logits=False)
+            for idx, key in enumerate(missing):
+                states[key] = prefilled.row_state(idx)
+                cache.put(key, states[key])
+
+        init_seqs = [seq + encoded_meta for encoded_meta in encoded_metas]
+        capacity = max(
+            self.get_budget(input_data, len(init_seq)).memory_length
+            for init_seq, input_data in zip(init_seqs, input_datas)
+        )
+        init_mems = self.init_mems(capacity)
+        init_mems.load_rows([states[key] for key in keys])
+        return init_seqs, init_mems
 
     def calc_logits_and_mems(
-        self, seq: List[int], mems: torch.Tensor
-    ) -> Tuple[torch.Tensor, torch.Tensor]:
-        inp = np.array([seq[-1]], dtype=np.int32)[:, np.newaxis]
-        input_token = torch.from_numpy(inp).to(self.device).type(torch.long)
-        ret = self.model.forward_generate(input_token, mems)
-        all_logits, mems = ret
-        logits = all_logits[-1, 0][1:]
-        return logits, mems
-
-    def calc_probs(self, logits):
-        # Handle temp 0 (argmax) case
-        if self.input_data.temperature == 0:
-            probs = torch.zeros_like(logits)
-            probs[logits.argmax()] = 1.0
+        self, tokens: List[int], mems: IncrementalMems
+    ) -> Tuple[torch.Tensor, IncrementalMems]:
+        """
+        feed one token per batch row, returns logits :: [bsz x vocab - 1]
+        """
+        return self.calc_chunk_logits_and_mems([[token] for token in tokens], mems)
+
+    def calc_chunk_logits_and_mems(
+        self, chunks: List[List[int]], mems: IncrementalMems
+    ) -> Tuple[torch.Tensor, IncrementalMems]:
+        """
+        feed a chunk of tokens per batch row in a single forward, chunks share the same length
+        returns the logits after the last token :: [bsz x vocab - 1]
+        """
+        inp = np.array(chunks, dtype=np.int32).T
+        return self.forward_tokens(inp, mems)
+
+    def sample_tokens(self, rows: List[DecodingRow]) -> List[Optional[int]]:
+        """
+        sample a token for every row from its latest logits in a single batched call
+        returns None for the rows that could not be sampled
+        """
+        temperatures = [row.teacher.input_data.temperature for row in rows]
+        top_ks = [row.teacher.input_data.top_k for row in rows]
+        has_banned = any(row.teacher.wrong_tokens for row in rows)
+        if self.onnx_decoder is not None:
+            logits = np.stack([row.logits for row in rows])
+            banned = None
+            if has_banned:
+                banned = np.zeros((logits.shape[0], logits.shape[1] + 1), dtype=bool)
+                for idx, row in enumerate(rows):
+                    banned[idx, row.teacher.wrong_tokens] = True
+            tokens = sample_tokens_numpy(logits, temperatures, top_ks, banned)
         else:
-            # Apply temperature spec
-            logits /= self.input_data.temperature
-            # Compute softmax
-            probs = F.softmax(logits, dim=-1)
-
-        probs = F.pad(probs, [1, 0])
-        return probs
-
-    def apply_sampling(self, probs, wrong_tokens):
-        _, top_idx = torch.topk(probs, self.input_data.top_k)
-        mask = torch.zeros_like(probs)
-        mask[top_idx] = 1.0
-        if wrong_tokens:
-            for w in wrong_tokens:
-                mask[w] = 0.0
-        probs *= mask
-        probs /= torch.sum(probs)
-        return probs
-
-    def infer_token(self, probs):
-        token = torch.multinomial(probs, 1)
-        token = int(token.item())
-        return token
-
-    def generate_sequence(self, seq, mems):
-        logits = None
-        teacher = TeacherForceTask(self.input_data)
-        first_loop = True
-        for _ in range(self.inference_cfg.GENERATION.generation_length):
-            if seq[-1] == 1:
-                break
+            import torch
+
+            logits = torch.stack([row.logits for row in rows])
+            banned = None
+            if has_banned:
+                banned = torch.zeros(
+                    logits.size(0), logits.size(1) + 1, dtype=torch.bool, device=logits.device
+                )
+                for idx, row in enumerate(rows):
+                    banned[idx, row.teacher.wrong_tokens] = True
+            tokens = sample_tokens(logits, temperatures, top_ks, banned)
+        # the temperature was applied in place, so sampling again from the same logits applies it twice
+        for row, row_logits in zip(rows, logits):
+            row.logits = row_logits
+        return [token if token >= 0 else None for token in tokens.tolist()]
+
+    def queue_forced_tokens(self, row: DecodingRow) -> List[int]:
+        """
+        append the teacher forced tokens, each one takes a loop step of its own
+        and the last one is fed once more by the step that samples after it
+        """
+        teacher = row.teacher
+        generation_length = row.budget.num_steps
+        forced_tokens = []
+        while teacher.next_tokens_forced and row.num_steps < generation_length:
+            row.num_steps += 1
+            next_token = teacher.next_tokens_forced.popleft()
+            row.append(next_token)
+            if next_token == TOKEN_OFFSET.EOS.value:
+                return []
+            forced_tokens.append(next_token)
+
+        if not forced_tokens or row.num_steps >= generation_length:
+            return []
+        return forced_tokens + forced_tokens[-1:]
+
+    def start_step(self, row: DecodingRow) -> bool:
+        """
+        take a loop step of one row and apply the teacher forcing that does not need a sample
+        returns whether a token has to be sampled, otherwise `row.next_tokens` is set
+        """
+        seq, teacher = row.seq, row.teacher
+        if row.num_steps >= row.budget.num_steps:
+            row.next_tokens = []
+            return False
+        row.num_steps += 1
 
-            if teacher.next_tokens_forced:
-                next_token = teacher.next_tokens_forced.pop(0)
-                seq.append(next_token)
-                logits, mems = self.calc_logits_and_mems(seq, mems)
-                continue
-
-            if teacher.no_sequence_appended:
-                assert logits is not None
-                teacher.no_sequence_appended = False
-            elif first_loop:
-                logits, _ = self.calc_logits_and_mems(seq, mems)
-                first_loop = False
-            else:
-                logits, mems = self.calc_logits_and_mems(seq, mems)
+        # teacher forcing
+        # in case with incomplete measure, trigger a flag after second bar token
+        if not teacher.incomplete_filled:
+            teacher.incomplete_filled = True if teacher.num_bars > 1 else False
 
-            probs = self.calc_probs(logits)
-            probs = self.apply_sampling(probs, teacher.wrong_tokens)
+        # forcefully assign position 1/128 right after bar token
+        if teacher.check_first_position(seq):
+            teacher.teach_first_position()
+            row.next_tokens = self.queue_forced_tokens(row)
+            return False
 
-            # teacher forcing
-            # in case with incomplete measure, trigger a flag after second bar token
-            if not teacher.incomplete_filled:
-                teacher.incomplete_filled = True if seq.count(TOKEN_OFFSET.BAR.value) > 1 else False
+        # in case there is one chord per bar
+        if teacher.check_one_chord_per_bar_case(seq):
+            teacher.teach_chord_token()
+            row.next_tokens = self.queue_forced_tokens(row)
+            return False
 
-            # forcefully assign position 1/128 right after bar token
-            if teacher.check_first_position(seq):
-                teacher.teach_first_position()
-                continue
+        # in case the chord changes within a bar
+        if teacher.check_mul_chord_per_bar_case(seq):
+            teacher.teach_chord_token()
+            row.next_tokens = self.queue_forced_tokens(row)
+            return False
 
-            # in case there is one chord per bar
-            if teacher.check_one_chord_per_bar_case(seq):
-                teacher.teach_chord_token()
-                continue
+        if self.grammar is not None:
+            # tokens breaking the event grammar are never sampled
+            row.logits = self.grammar.mask_logits(
+                row.logits, seq[-1], teacher.check_remnant_chord()
+            )
+        return True
 
-            # in case the chord changes within a bar
-            if teacher.check_mul_chord_per_bar_case(seq):
-                teacher.teach_chord_token()
-                continue
+    def finish_step(self, row: DecodingRow, token: int) -> bool:
+        """
+        apply the teacher forcing that checks the sampled token, then append it
+        returns whether the row has to sample again from the same logits
+        """
+        teacher = row.teacher
 
-            # teacher forcing followed by token inference so that we can check if the wrong token was generated
-            try:
-                token = self.infer_token(probs)
-            except RuntimeError as e:
-                logger.error(f"Sampling Error: {e}")
-                seq = None
-                break
+        # generated token skipped necessary position
+        if teacher.check_chord_position_passed(token):
+            teacher.teach_chord_position()
+            row.next_tokens = self.queue_forced_tokens(row)
+            return False
 
-            # generated token skipped necessary position
-            if teacher.check_chord_position_passed(token):
-                teacher.teach_chord_position()
-                continue
+        # wrong chord token generated, sample again from the same logits
+        if teacher.check_wrong_chord_token_generated(token):
+            teacher.teach_wrong_chord_token(token)
+            teacher.no_sequence_appended = False
+            return True
 
-            # wrong chord token generated
-            if teacher.check_wrong_chord_token_generated(token):
-                teacher.teach_wrong_chord_token(token)
-                continue
+        # eos generated but we got more chords to write
+        if teacher.check_wrong_eos_generated(token):
+            teacher.teach_remnant_chord()
+            row.next_tokens = self.queue_forced_tokens(row)
+            return False
 
-            # eos generated but we got more chords to write
-            if teacher.check_wrong_eos_generated(token):
-                teacher.teach_remnant_chord()
-                continue
+        # bar token generated but num measures exceed
+        if teacher.check_wrong_bar_token_generated(token):
+            teacher.teach_eos()
+            row.next_tokens = self.queue_forced_tokens(row)
+            return False
 
-            # bar token generated but num measures exceed
-            if teacher.check_wrong_bar_token_generated(token):
-                teacher.teach_eos()
-                continue
+        row.append(token)
+        if token == TOKEN_OFFSET.EOS.value or row.num_steps >= row.budget.num_steps:
+            row.next_tokens = []
+        else:
+            row.next_tokens = [token]
+        return False
 
-            seq.append(token)
+    def advance(self, rows: List[DecodingRow]) -> None:
+        """
+        run the teacher forced sampling of the rows on their latest logits,
+        setting the tokens each row feeds before it needs new logits (empty when finished)
+        the rows waiting for a sampled token are sampled together
+        """
+        for row in rows:
+            # bar boundaries are the points a failed row is rolled back to
+            if row.seq[-1] == TOKEN_OFFSET.BAR.value:
+                row.take_snapshot()
+
+        pending = rows
+        while pending:
+            sampling = [row for row in pending if self.start_step(row)]
+            if not sampling:
+                break
+            tokens = self.sample_tokens(sampling)
+            pending = []
+            for row, token in zip(sampling, tokens):
+                if token is None:
+                    logger.error("Sampling Error: no token left to sample")
+                    row.failed = True
+                    row.next_tokens = []
+                elif self.finish_step(row, token):
+                    pending.append(row)
+
+    def init_rows(
+        self, seqs: List[List[int]], input_datas: Optional[List[TransXlInputData]] = None
+    ) -> List[DecodingRow]:
+        if input_datas is None:
+            input_datas = [self.input_data] * len(seqs)
+        return [
+            DecodingRow(seq, TeacherForceTask(input_data), self.get_budget(input_data, len(seq)))
+            for seq, input_data in zip(seqs, input_datas)
+        ]
 
+    def generate_sequences(
+        self,
+        seqs: List[List[int]],
+        mems: IncrementalMems,
+        input_datas: Optional[List[TransXlInputData]] = None,
+    ) -> List[Optional[List[int]]]:
+        """
+        decode the sequences together, one per row of the batch
+        """
+        rows = self.init_rows(seqs, input_datas)
+        steps = self.iter_decode(rows, mems)
+        while True:
+            try:
+                next(steps)
+            except StopIteration as stop:
+                is_valid = stop.value
+                break
+        return [row.seq if valid else None for row, valid in zip(rows, is_valid)]
+
+    def iter_decode(
+        self, rows: List[DecodingRow], mems: IncrementalMems
+    ) -> Generator[None, None, List[bool]]:
+        """
+        decode the rows together, yielding after every step and after every rollback
+        a failed row is rolled back to its last bar up to `max_rollbacks` times
+        returns whether each row holds a valid sequence
+        """
+        # the last meta token is not kept in the memory
+        mlen = len(mems)
+        logits, mems = self.calc_logits_and_mems([row.seq[-1] for row in rows], mems)
+        mems.truncate(mlen)
+        for row, row_logits in zip(rows, logits):
+            row.logits = row_logits
+        yield from self.iter_decode_rows(rows, mems)
+
+        # failed rows go back to their last bar instead of starting over
+        max_rollbacks = self.inference_cfg.GENERATION.get("max_rollbacks", 0)
+        is_valid = [self.validate_row(row) for row in rows]
+        while True:
+            retry = [
+                idx for idx, row in enumerate(rows)
+                if not is_valid[idx] and row.snapshot is not None and row.num_rollbacks < max_rollbacks
+            ]
+            if not retry:
+                break
+            length_to_rows = {}
+            for idx in retry:
+                rows[idx].roll_back()
+                length_to_rows.setdefault(len(rows[idx].get_context()), []).append(rows[idx])
+            self.retry_counts["rollbacks"] += len(retry)
+            logger.info(f"Rolling back {len(retry)} sequence(s) to their last bar")
+            yield
+            for group in length_to_rows.values():
+                yield from self.iter_decode_rows(group, self.prefill_rows(group))
+            for idx in retry:
+                is_valid[idx] = self.validate_row(rows[idx])
+
+        return is_valid
+
+    def prefill_rows(self, rows: List[DecodingRow]) -> IncrementalMems:
+        """
+        rebuild the memory of rows rolled back to a snapshot, contexts share the same length
+        and set the logits after their last fed token
+        """
+        ctx = np.array([row.get_context() for row in rows], dtype=np.int32).T
+        capacity = max(row.budget.memory_length for row in rows)
+        logits, mems = self.forward_tokens(ctx, self.init_mems(max(capacity, len(ctx))))
+        for row, row_logits in zip(rows, logits):
+            row.logits = row_logits
+        return mems
+
+    def iter_decode_rows(
+        self, rows: List[DecodingRow], mems: IncrementalMems
+    ) -> Iterator[None]:
+        """
+        decode the rows together from their latest logits until every one is finished,
+        yielding after every step
+        rows drop out of the batch as soon as they are finished
+        """
+        self.advance(rows)
+        yield
+
+        active = rows
+        while True:
+            keep = [idx for idx, row in enumerate(active) if row.next_tokens]
+            if len(keep) != len(active):
+                active = [active[idx] for idx in keep]
+                if not active:
+                    break
+                mems.select(keep)
+
+            # teacher forced tokens are known ahead of time,
+            # so the run pending in every row is fed as one chunk
+            chunk_len = min(len(row.next_tokens) for row in active)
+            chunks = []
+            for row in active:
+                chunks.append(row.next_tokens[:chunk_len])
+                row.fed_tokens.extend(chunks[-1])
+                del row.next_tokens[:chunk_len]
+            logits, mems = self.calc_chunk_logits_and_mems(chunks, mems)
+            waiting = []
+            for row, row_logits in zip(active, logits):
+                if not row.next_tokens:
+                    row.logits = row_logits
+                    waiting.append(row)
+            self.advance(waiting)
+            yield
+
+    def validate_row(self, row: DecodingRow) -> bool:
+        if row.failed:
+            return False
         try:
-            teacher.validate_teacher_forced_sequence(seq)
+            row.teacher.validate_teacher_forced_sequence(row.seq)
         except Exception as error_message:
             logger.error(error_message)
-            seq = None
-        return seq
+            return False
+        return True
+
+    def generate_sequence(self, seq: List[int], mems: IncrementalMems) -> Optional[List[int]]:
+        return self.generate_sequences([seq], mems)[0]
 
     def validate_generated_sequence(self, seq: List[int]) -> bool:
         num_note = 0
@@ -335,20 +809,89 @@ class InferenceTask:
                     num_note += 1
         return num_note > 0
 
-    def execute(self, encoded_meta) -> List[List[int]]:
-        num_conditional_tokens = len(encoded_meta)
-        idx = 0
-        sequences = []
-        while idx != self.input_data.num_generate:
-            with torch.no_grad():
-                logger.info("Generating the idx: " + str(idx + 1))
-                seq, mems = self.init_seq_and_mems(encoded_meta, num_conditional_tokens)
-                seq = self.generate_sequence(seq, mems)
-                if seq is None:
-                    continue
-                if not self.validate_generated_sequence(seq):
+    def stream_batch(
+        self, encoded_metas: List[List[int]], input_datas: List[TransXlInputData]
+    ) -> Iterator[StreamEvent]:
+        """
+        generate one sequence for every pair of encoded meta and input data,
+        decoding them together and retrying the failed ones
+        yields the tokens of every sequence as they are decoded and the notes they complete
+        """
+        batch_size = self.inference_cfg.GENERATION.get("batch_size", 1)
+        self.retry_counts = {"rollbacks": 0, "restarts": 0}
+        is_finished = [False] * len(encoded_metas)
+        started = set()
+        while True:
+            missing = [idx for idx, finished in enumerate(is_finished) if not finished][:batch_size]
+            if not missing:
+                break
+            self.retry_counts["restarts"] += len(started.intersection(missing))
+            started.update(missing)
+            logger.info(f"Generating the idx: {', '.join(str(idx + 1) for idx in missing)}")
+            batch_input_datas = [input_datas[idx] for idx in missing]
+            with self.no_grad():
+                seqs, mems = self.init_seqs_and_mems(
+                    [encoded_metas[idx] for idx in missing], batch_input_datas
+                )
+            rows = self.init_rows(seqs, batch_input_datas)
+            streams = [
+                NoteStream(input_data.time_signature, len(seq))
+                for seq, input_data in zip(seqs, batch_input_datas)
+            ]
+            num_rollbacks = [0] * len(rows)
+
+            # gradients are only disabled while decoding, not while the consumer runs
+            steps = self.iter_decode(rows, mems)
+            while True:
+                try:
+                    with self.no_grad():
+                        next(steps)
+                except StopIteration as stop:
+                    is_valid = stop.value
+                    break
+                for row_idx, (idx, row, stream) in enumerate(zip(missing, rows, streams)):
+                    if row.num_rollbacks != num_rollbacks[row_idx]:
+                        num_rollbacks[row_idx] = row.num_rollbacks
+                        stream.roll_back(row.seq)
+                        yield StreamEvent("rollback", idx, stream.num_tokens, stream.num_notes, [], [])
+                    tokens, notes = stream.read(row.seq)
+                    if tokens:
+                        yield StreamEvent(
+                            "tokens", idx, stream.num_tokens, stream.num_notes, tokens, notes
+                        )
+
+            for idx, row, stream, valid in zip(missing, rows, streams, is_valid):
+                if valid and not self.validate_generated_sequence(row.seq):
                     logger.error("Empty sequence generated")
-                    continue
-            sequences.append(seq)
-            idx += 1
+                    valid = False
+                if valid:
+                    is_finished[idx] = True
+                    yield StreamEvent(
+                        "finished", idx, stream.num_tokens, stream.num_notes, [], [], row.seq
+                    )
+                else:
+                    yield StreamEvent("restart", idx, 0, 0, [], [])
+        logger.info(
+            f"rollbacks: {self.retry_counts['rollbacks']}, restarts: {self.retry_counts['restarts']}"
+        )
+
+    def stream(self, encoded_meta) -> Iterator[StreamEvent]:
+        num_generate = self.input_data.num_generate
+        return self.stream_batch([encoded_meta] * num_generate, [self.input_data] * num_generate)
+
+    def execute_batch(
+        self, encoded_metas: List[List[int]], input_datas: List[TransXlInputData]
+    ) -> List[List[int]]:
+        """
+        generate one sequence for every pair of encoded meta and input data,
+        decoding them together and retrying the failed ones
+        """
+        sequences = [None] * len(encoded_metas)
+        for event in self.stream_batch(encoded_metas, input_datas):
+            if event.kind == "finished":
+                sequences[event.idx] = event.seq
         return sequences
+
+    def execute(self, encoded_meta) -> List[List[int]]:
+        num_generate = self.input_data.num_generate
+        return self.execute_batch([encoded_meta] * num_generate, [self.input_data] * num_generate)
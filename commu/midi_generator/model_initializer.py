@@ -1,21 +1,34 @@
+from __future__ import annotations
+
 from pathlib import Path
-from typing import Tuple
+from typing import TYPE_CHECKING, Optional, Tuple, Union
 
-import torch
 import yacs.config
 
+from commu.logger import logger
 from commu.midi_generator.container import ModelArguments
+from commu.midi_generator.model_registry import MODEL_REGISTRY
+from commu.midi_generator.onnx_runtime import OnnxRuntimeDecoder
 from commu.model.config_helper import get_default_cfg_inference, get_default_cfg_training
-from commu.model.dataset import BaseVocab
-from commu.model.model import MemTransformerLM
+
+# the onnxruntime backend runs without torch, which only the torch backend imports
+if TYPE_CHECKING:
+    import torch
+
+    from commu.model.decode_step import CompiledDecodeStep
+    from commu.model.model import MemTransformerLM
 
 
 class ModelInitializeTask:
-    def __init__(self, model_args: ModelArguments, map_location: str, device: torch.device):
+    def __init__(
+        self, model_args: ModelArguments, map_location: str, device: Optional[torch.device]
+    ):
         self.model_args = model_args
         self.map_location = map_location
         self.device = device
         self.inference_cfg = self.initialize_inference_config()
+        # traced single-token step of the model returned by `execute`, None unless opted in
+        self.decode_step: Optional[CompiledDecodeStep] = None
 
     def initialize_inference_config(self) -> yacs.config.CfgNode:
         inference_cfg = get_default_cfg_inference()
@@ -41,6 +54,11 @@ class ModelInitializeTask:
         return cfg
 
     def initialize_model(self, training_cfg, model_fp):
+        import torch
+
+        from commu.model.dataset import BaseVocab
+        from commu.model.model import MemTransformerLM
+
         perform_vocab = BaseVocab()
         model = MemTransformerLM(training_cfg, perform_vocab)
         checkpoint = torch.load(model_fp, map_location=torch.device("cuda" if torch.cuda.is_available() else "cpu"))
@@ -50,8 +68,76 @@ class ModelInitializeTask:
         model.reset_length(1, self.inference_cfg.MODEL.memory_length)
         return model
 
-    def execute(self):
+    def use_quantization(self) -> bool:
+        if self.model_args.quantize and self.device.type != "cpu":
+            logger.warning("int8 quantization only runs on cpu, loading the fp32 model")
+            return False
+        return self.model_args.quantize
+
+    def use_bfloat16(self, quantize: bool) -> bool:
+        if not self.model_args.bfloat16:
+            return False
+        if quantize:
+            logger.warning("bf16 is ignored for the int8 quantized model")
+            return False
+        from commu.model.quantization import bfloat16_supported
+
+        if self.device.type == "cpu" and not bfloat16_supported():
+            logger.warning("this cpu has no native bf16 support, loading the fp32 model")
+            return False
+        return True
+
+    def load_onnx_decoder(self, model_fp: Path) -> OnnxRuntimeDecoder:
+        """
+        onnxruntime decoder over the graphs exported next to the checkpoint,
+        the model is only loaded to export them when they are missing or older than the checkpoint
+        """
+        prefill_fp = model_fp.with_name(f"{model_fp.stem}.prefill.onnx")
+        decode_fp = model_fp.with_name(f"{model_fp.stem}.decode.onnx")
+        checkpoint_mtime = model_fp.stat().st_mtime
+        if not all(fp.exists() and fp.stat().st_mtime >= checkpoint_mtime for fp in (prefill_fp, decode_fp)):
+            from commu.model.onnx_export import export_onnx
+
+            model = self.initialize_model(self.initialize_training_cfg(), model_fp)
+            export_onnx(model, prefill_fp, decode_fp)
+        return OnnxRuntimeDecoder(prefill_fp, decode_fp, self.inference_cfg.MODEL.memory_length)
+
+    def execute(self) -> Union[MemTransformerLM, OnnxRuntimeDecoder]:
         model_fp, training_cfg_fp = self.load_checkpoint_fp()
-        training_cfg = self.initialize_training_cfg()
-        model = self.initialize_model(training_cfg, model_fp)
+        if self.model_args.backend == "onnxruntime":
+            return MODEL_REGISTRY.get_or_load(
+                model_fp, "cpu", "onnxruntime", lambda: self.load_onnx_decoder(model_fp)
+            )
+        return self.load_torch_model(model_fp)
+
+    def load_torch_model(self, model_fp: Path) -> MemTransformerLM:
+        import torch
+
+        from commu.model.decode_step import get_compiled_decode_step, load_or_trace_decode_step
+        from commu.model.quantization import cast_bfloat16, quantize_dynamic_int8
+
+        quantize = self.use_quantization()
+        bfloat16 = self.use_bfloat16(quantize)
+
+        def load_model():
+            training_cfg = self.initialize_training_cfg()
+            model = self.initialize_model(training_cfg, model_fp)
+            if quantize:
+                model = quantize_dynamic_int8(model)
+            elif bfloat16:
+                model = cast_bfloat16(model)
+            return model
+
+        # the checkpoint is loaded once per process and the model shared afterwards
+        dtype = torch.qint8 if quantize else torch.bfloat16 if bfloat16 else torch.float32
+        model = MODEL_REGISTRY.get_or_load(model_fp, self.device, dtype, load_model)
+        # the traced step is shared with the model, but only used by the tasks asking for it
+        self.decode_step = None
+        if self.model_args.compile_decode_step:
+            self.decode_step = get_compiled_decode_step(model)
+            if self.decode_step is None:
+                artifact_fp = model_fp.with_name(
+                    f"{model_fp.stem}.decode_step.{self.device.type}.{str(dtype).split('.')[-1]}.pt"
+                )
+                self.decode_step = load_or_trace_decode_step(model, model_fp, artifact_fp)
         return model
\ No newline at end of file
@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Dict, Tuple, Union
+
+if TYPE_CHECKING:
+    import torch
+
+    from commu.model.model import MemTransformerLM
+
+ModelKey = Tuple[str, str, str]
+
+
+class ModelRegistry:
+    """
+    process-wide cache of initialized models
+    a checkpoint is loaded once per process and every pipeline asking for the
+    same checkpoint, device and dtype shares the same eval-mode model
+    """
+    def __init__(self):
+        self._models: Dict[ModelKey, MemTransformerLM] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(
+        model_fp: Union[str, Path],
+        device: Union[torch.device, str],
+        dtype: Union[torch.dtype, str],
+    ) -> ModelKey:
+        return str(Path(model_fp).resolve()), str(device), str(dtype)
+
+    def get_or_load(
+        self,
+        model_fp: Union[str, Path],
+        device: Union[torch.device, str],
+        dtype: Union[torch.dtype, str],
+        load_model: Callable[[], MemTransformerLM],
+    ) -> MemTransformerLM:
+        key = self.make_key(model_fp, device, dtype)
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                model = load_model()
+                self._models[key] = model
+        return model
+
+    def clear(self) -> None:
+        with self._lock:
+            self._models.clear()
+
+
+MODEL_REGISTRY = ModelRegistry()
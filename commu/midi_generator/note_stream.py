@@ -0,0 +1,85 @@
+from typing import List, Tuple
+
+import miditoolkit
+import numpy as np
+
+from commu.preprocessor.encoder import encoder_utils, get_vocabulary
+from commu.preprocessor.encoder.event_tokens import EVENT_KIND
+from commu.preprocessor.utils.constants import DEFAULT_POSITION_RESOLUTION, DEFAULT_TICKS_PER_BEAT
+
+NOTE_KINDS = [
+    EVENT_KIND.POSITION, EVENT_KIND.NOTE_VELOCITY, EVENT_KIND.NOTE_ON, EVENT_KIND.NOTE_DURATION
+]
+
+
+class NoteStream:
+    """
+    notes completed by the tokens of a sequence while it is decoded,
+    (Position -> Note Velocity -> Note On -> Note Duration) groups timed as `write_midi` does
+
+    `start` is the index of the first generated token, which is left out of the
+    event sequence decoded by `PostprocessTask` just as it is here
+    """
+    def __init__(self, time_signature: str, start: int):
+        numerator, denominator = time_signature.split("/")
+        beats_per_bar = int(int(numerator) / int(denominator) * 4)
+        self.ticks_per_bar = DEFAULT_TICKS_PER_BEAT * beats_per_bar
+        self.duration_bins = np.arange(
+            int(self.ticks_per_bar / DEFAULT_POSITION_RESOLUTION),
+            self.ticks_per_bar + 1,
+            int(self.ticks_per_bar / DEFAULT_POSITION_RESOLUTION),
+        )
+        self.start = start
+        self.vocabulary = get_vocabulary()
+        self.reset()
+
+    def reset(self) -> None:
+        self.num_read = self.start
+        self.num_bars = 0
+        self.num_notes = 0
+        # the event sequence leaves out the tokens `decode_words` leaves out
+        self.num_events = 0
+        self.last_events = []
+
+    def is_note(self, events: List[int]) -> bool:
+        return [self.vocabulary.kinds[word] for word in events] == NOTE_KINDS
+
+    def make_note(self, events: List[int]) -> miditoolkit.Note:
+        """
+        the note `write_midi` writes for the group, through the same lookup tables and timing
+        """
+        position, velocity_index, pitch, duration_index = (self.vocabulary.values[word] for word in events)
+        temp_note = [self.num_bars, position, velocity_index, pitch, duration_index]
+        return encoder_utils.make_notes(temp_note, self.ticks_per_bar, self.duration_bins)[0]
+
+    def read(self, seq: List[int]) -> Tuple[List[int], List[miditoolkit.Note]]:
+        """
+        returns the tokens appended since the last read and the notes they complete
+        """
+        notes = []
+        for token in seq[max(self.num_read, self.start + 1):]:
+            kind = self.vocabulary.kinds[token] if 0 <= token < len(self.vocabulary.kinds) else EVENT_KIND.NONE
+            if kind == EVENT_KIND.NONE:
+                continue
+            self.last_events = self.last_events[-3:] + [token]
+            if kind == EVENT_KIND.BAR:
+                # the first event is never counted as a bar
+                self.num_bars += self.num_events > 0
+            elif self.is_note(self.last_events):
+                notes.append(self.make_note(self.last_events))
+            self.num_events += 1
+        self.num_notes += len(notes)
+        tokens = seq[self.num_read:]
+        self.num_read = len(seq)
+        return tokens, notes
+
+    def roll_back(self, seq: List[int]) -> None:
+        """
+        forget the tokens past the end of `seq`, which was cut back
+        """
+        self.reset()
+        self.read(seq)
+
+    @property
+    def num_tokens(self) -> int:
+        return self.num_read - self.start
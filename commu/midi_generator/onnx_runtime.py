@@ -0,0 +1,129 @@
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+class OnnxMems:
+    """
+    Memory of the onnxruntime decoder: keys/values of every layer in one array,
+        buffer :: [capacity x n_layer x 2 x bsz x n_head*d_head]
+    with the time axis first, so the live window `buffer[beg:end]` is contiguous
+    and is fed to the decode graph without a copy.
+    """
+
+    def __init__(self, mem_len: int, capacity: Optional[int] = None):
+        self.mem_len = mem_len
+        self.capacity = 2 * mem_len if capacity is None else capacity
+        self.buffer = None
+        self.beg = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.beg
+
+    def window(self) -> Optional[np.ndarray]:
+        if self.buffer is None:
+            return None
+        return self.buffer[self.beg: self.end]
+
+    def append(self, new_kv: np.ndarray) -> None:
+        """
+            new_kv :: [qlen x n_layer x 2 x bsz x n_head*d_head]
+        """
+        qlen = new_kv.shape[0]
+        if self.buffer is None:
+            self.buffer = np.empty((max(self.capacity, qlen),) + new_kv.shape[1:], new_kv.dtype)
+        elif self.end + qlen > self.buffer.shape[0]:
+            self._compact(qlen)
+        self.buffer[self.end: self.end + qlen] = new_kv
+        self.end += qlen
+        self.beg = max(self.beg, self.end - self.mem_len)
+
+    def _compact(self, qlen: int) -> None:
+        length = len(self)
+        if length + qlen > self.buffer.shape[0]:
+            buffer = np.empty(
+                (max(2 * self.buffer.shape[0], length + qlen),) + self.buffer.shape[1:],
+                self.buffer.dtype,
+            )
+        else:
+            buffer = self.buffer
+        # copies through a temporary when source and destination overlap
+        buffer[:length] = self.buffer[self.beg: self.end]
+        self.buffer = buffer
+        self.beg, self.end = 0, length
+
+    def truncate(self, length: int) -> None:
+        self.end = min(self.end, self.beg + length)
+
+    def row_state(self, idx: int) -> List[np.ndarray]:
+        """
+        copy of the memory of one batch row, [mlen x n_layer x 2 x 1 x d]
+        """
+        return [self.window()[:, :, :, idx: idx + 1].copy()]
+
+    def load_rows(self, row_states: List[List[np.ndarray]]) -> None:
+        window = np.concatenate([state[0] for state in row_states], axis=3)
+        length = window.shape[0]
+        self.buffer = np.empty((max(self.capacity, length),) + window.shape[1:], window.dtype)
+        self.buffer[:length] = window
+        self.beg, self.end = 0, length
+
+    def select(self, indices) -> None:
+        if self.buffer is None:
+            return
+        window = self.window().take(np.asarray(indices, dtype=np.int64), axis=3)
+        length = window.shape[0]
+        self.buffer = np.empty((self.buffer.shape[0],) + window.shape[1:], window.dtype)
+        self.buffer[:length] = window
+        self.beg, self.end = 0, length
+
+
+class OnnxRuntimeDecoder:
+    """
+    `MemTransformerLM` decoding through the graphs written by `commu.model.onnx_export`,
+    on the onnxruntime CPU provider. Only numpy is needed at runtime.
+    """
+
+    def __init__(self, prefill_fp: Path, decode_fp: Path, mem_len: int, num_threads: int = 0):
+        if onnxruntime is None:
+            raise ImportError("onnxruntime is required by the onnxruntime backend")
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        providers = ["CPUExecutionProvider"]
+        self.prefill_session = onnxruntime.InferenceSession(
+            str(prefill_fp), options, providers=providers
+        )
+        self.decode_session = onnxruntime.InferenceSession(
+            str(decode_fp), options, providers=providers
+        )
+        self.mem_len = mem_len
+
+    def init_mems(self, capacity: Optional[int] = None) -> OnnxMems:
+        return OnnxMems(self.mem_len, capacity)
+
+    def forward(
+        self, data: np.ndarray, mems: Optional[OnnxMems]
+    ) -> Tuple[np.ndarray, OnnxMems]:
+        """
+            data :: [len x bsz] tokens fed after `mems` (a new memory when None)
+            returns the logits after the last token :: [bsz x n_token],
+            `mems` is updated in place
+        """
+        data = np.ascontiguousarray(data, dtype=np.int64)
+        if mems is None:
+            mems = self.init_mems()
+        if len(mems) == 0:
+            logits, new_kv = self.prefill_session.run(None, {"data": data})
+        else:
+            logits, new_kv = self.decode_session.run(
+                None, {"data": data, "mems": mems.window()}
+            )
+        mems.append(new_kv)
+        return logits, mems
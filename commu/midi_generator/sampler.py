@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Optional, Sequence
+
+import numpy as np
+
+if TYPE_CHECKING:
+    import torch
+
+
+def sample_tokens(
+    logits: torch.Tensor,
+    temperatures: Sequence[float],
+    top_ks: Sequence[int],
+    banned: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """
+    temperature, top-k filtering, banned tokens and sampling over a batch of rows at once
+
+        logits :: [bsz x vocab - 1], without the padding token,
+            divided by the temperatures in place
+        temperatures, top_ks :: one per row, a temperature of 0 takes the argmax
+        banned :: [bsz x vocab] tokens removed after the top-k filtering
+        returns the sampled tokens :: [bsz], -1 for the rows left without any token to sample
+    """
+    # torch is only imported by the torch backend
+    import torch
+    import torch.nn.functional as F
+
+    bsz = logits.size(0)
+    greedy = [temperature == 0 for temperature in temperatures]
+    if any(greedy):
+        probs = torch.zeros_like(logits)
+        if not all(greedy):
+            scale = [1.0 if is_greedy else t for is_greedy, t in zip(greedy, temperatures)]
+            logits.div_(logits.new_tensor(scale)[:, None])
+            probs = F.softmax(logits, dim=-1)
+        greedy = torch.tensor(greedy, device=logits.device)
+        probs[greedy] = F.one_hot(logits[greedy].argmax(dim=-1), logits.size(-1)).to(probs.dtype)
+    else:
+        if len(set(temperatures)) == 1:
+            logits.div_(temperatures[0])
+        else:
+            logits.div_(logits.new_tensor(temperatures)[:, None])
+        probs = F.softmax(logits, dim=-1)
+    probs = F.pad(probs, [1, 0])
+
+    # keep the `top_k` most probable tokens of every row
+    max_top_k = max(top_ks)
+    _, top_idx = torch.topk(probs, max_top_k)
+    mask = torch.zeros_like(probs)
+    if min(top_ks) == max_top_k:
+        mask.scatter_(1, top_idx, 1.0)
+    else:
+        top_ks = torch.tensor(top_ks, device=probs.device)
+        in_top_k = torch.arange(max_top_k, device=probs.device)[None, :] < top_ks[:, None]
+        mask.scatter_(1, top_idx, in_top_k.to(probs.dtype))
+    if banned is not None:
+        mask.masked_fill_(banned, 0.0)
+    probs *= mask
+    total = probs.sum(dim=-1, keepdim=True)
+    probs /= total
+
+    try:
+        return torch.multinomial(probs, 1).view(bsz)
+    except RuntimeError:
+        # rows left without any token to sample (or with nan) get -1 instead of a token
+        valid = total.view(bsz) > 0
+        probs[~valid] = 0.0
+        probs[~valid, 0] = 1.0
+        tokens = torch.multinomial(probs, 1).view(bsz)
+        return tokens.masked_fill_(~valid, -1)
+
+
+def sample_tokens_numpy(
+    logits: np.ndarray,
+    temperatures: Sequence[float],
+    top_ks: Sequence[int],
+    banned: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    `sample_tokens` on the numpy logits of the onnxruntime backend, which runs without torch
+    the tokens are drawn from `np.random`
+    """
+    bsz = logits.shape[0]
+    greedy = np.array([temperature == 0 for temperature in temperatures])
+    scale = np.where(greedy, 1.0, np.asarray(temperatures, dtype=np.float64)).astype(logits.dtype)
+    logits /= scale[:, None]
+    with np.errstate(invalid="ignore"):
+        probs = np.exp(logits - logits.max(axis=-1, keepdims=True))
+        probs /= probs.sum(axis=-1, keepdims=True)
+    if greedy.any():
+        probs[greedy] = 0.0
+        probs[greedy, logits[greedy].argmax(axis=-1)] = 1.0
+    probs = np.pad(probs, [(0, 0), (1, 0)])
+
+    # keep the `top_k` most probable tokens of every row
+    top_idx = np.argsort(-probs, axis=-1, kind="stable")[:, :max(top_ks)]
+    in_top_k = np.arange(top_idx.shape[1])[None, :] < np.asarray(top_ks)[:, None]
+    mask = np.zeros_like(probs)
+    np.put_along_axis(mask, top_idx, in_top_k.astype(probs.dtype), axis=1)
+    if banned is not None:
+        mask[banned] = 0.0
+    probs *= mask
+
+    # inverse transform sampling, the draws are in (0, 1]
+    # so a token of zero probability is never taken
+    cdf = np.cumsum(probs, axis=-1)
+    total = cdf[:, -1]
+    draws = (1.0 - np.random.random_sample(bsz)) * total
+    tokens = np.minimum((cdf < draws[:, None]).sum(axis=-1), probs.shape[1] - 1)
+    # rows left without any token to sample (or with nan) get -1 instead of a token
+    return np.where(total > 0, tokens, -1)
@@ -1,3 +1,4 @@
+import io
 from pathlib import Path
 from typing import List
 
@@ -42,6 +43,22 @@ class PostprocessTask:
 
         return decoded_midi
 
+    def execute_in_memory(self, sequences: List[List[int]], meta_info_len: int) -> List[io.BytesIO]:
+        """
+        decode the sequences into midi files held in memory, without writing them to the output dir
+        """
+        buffers = []
+        for seq in sequences:
+            decoded_midi = self.decode_event_sequence(
+                generation_result=seq,
+                num_meta=meta_info_len,
+            )
+            buffer = io.BytesIO()
+            decoded_midi.dump(file=buffer)
+            buffer.seek(0)
+            buffers.append(buffer)
+        return buffers
+
     def execute(self, sequences: List[List[int]], meta_info_len: int) -> Path:
         for idx, seq in enumerate(sequences):
             decoded_midi = self.decode_event_sequence(
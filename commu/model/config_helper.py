@@ -74,6 +74,17 @@ def get_default_cfg_inference():
     # Model related parameters
     cfg.GENERATION = CN()
     cfg.GENERATION.generation_length = 4096
+    # number of candidates decoded together
+    cfg.GENERATION.batch_size = 16
+    # byte budget of the cached memories prefilled from the encoded meta, 0 disables it
+    cfg.GENERATION.prefix_cache_bytes = 256 * 2 ** 20
+    # mask the tokens breaking the event grammar before sampling
+    cfg.GENERATION.constrain_grammar = True
+    # rollbacks to the last bar allowed per sequence before it is generated again from scratch
+    cfg.GENERATION.max_rollbacks = 8
+    # tokens per bar by track role and time signature built by `build_tokens_per_bar.py`,
+    # the step budget and memory length of a sequence are derived from it (generation_length when missing)
+    cfg.GENERATION.tokens_per_bar_fp = "cfg/tokens_per_bar.yaml"
 
 
     cfg.freeze()
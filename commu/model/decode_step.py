@@ -0,0 +1,164 @@
+import weakref
+from pathlib import Path
+from typing import Optional, Tuple
+
+import torch
+import torch.nn as nn
+
+from commu.model.model import IncrementalMems, MemTransformerLM
+
+
+class DecodeStep(nn.Module):
+    """
+    Single-token incremental decode step of `MemTransformerLM` over static buffers.
+
+    Keys/values are read from and written into a fixed-size view of the
+    `IncrementalMems` buffers, with the slots past the current position masked
+    out, so the step has no Python control flow depending on the decode state
+    and can be traced once into a graph.
+    """
+
+    def __init__(self, model: MemTransformerLM):
+        super(DecodeStep, self).__init__()
+        self.model = model
+
+    def forward(self, token, pos, kv_buffers: Tuple[torch.Tensor, ...], rel_keys):
+        """
+            token :: [1 x bsz]
+            pos :: [] number of cached positions, the new token is written at this slot
+            kv_buffers :: one [2 x capacity x bsz x n_head*d_head] view per layer, updated in place
+            rel_keys :: [n_layer x capacity x n_head*d_head] for positions capacity-1 .. 0
+            returns logits :: [bsz x n_token]
+        """
+        model = self.model
+        n_head, d_head = model.n_head, model.d_head
+        capacity = rel_keys.size(1)
+        slots = torch.arange(capacity, device=token.device)
+        # the key at slot j is `pos - j` positions behind the new token
+        rel_idx = (slots + (capacity - 1) - pos).clamp(max=capacity - 1)
+        hidden_slots = (slots > pos)[None, None, None, :]
+        pos = pos.view(1)
+
+        core_out = model.word_emb(token)
+        for i, layer in enumerate(model.layers):
+            attn = layer.dec_attn
+            w_head_q, w_head_k, w_head_v = torch.chunk(attn.qkv_net(core_out), 3, dim=-1)
+            kv = kv_buffers[i]
+            kv.index_copy_(1, pos, torch.stack([w_head_k, w_head_v]))
+
+            w_head_q = w_head_q.view(1, -1, n_head, d_head)
+            w_head_k = kv[0].view(capacity, -1, n_head, d_head)
+            w_head_v = kv[1].view(capacity, -1, n_head, d_head)
+            r_head_k = rel_keys[i].index_select(0, rel_idx).view(capacity, n_head, d_head)
+
+            AC = torch.einsum("ibnd,jbnd->bnij", (w_head_q + model.r_w_bias, w_head_k))
+            BD = torch.einsum("ibnd,jnd->bnij", (w_head_q + model.r_r_bias, r_head_k))
+            attn_score = (AC + BD) * attn.scale
+            attn_score = attn_score.masked_fill(hidden_slots, -float("inf"))
+            attn_prob = torch.softmax(attn_score, dim=3)
+
+            attn_vec = torch.einsum("bnij,jbnd->ibnd", (attn_prob, w_head_v))
+            attn_vec = attn_vec.reshape(1, -1, n_head * d_head)
+            core_out = attn.layer_norm(core_out + attn.o_net(attn_vec))
+            core_out = layer.pos_ff(core_out)
+
+        pred_hid = core_out.reshape(-1, core_out.size(-1))
+        if model.crit.out_projs[0] is not None:
+            pred_hid = torch.nn.functional.linear(pred_hid, model.crit.out_projs[0].t().contiguous())
+        return model.crit.out_layers[0](pred_hid)
+
+
+class CompiledDecodeStep:
+    """
+    Traced `DecodeStep` used in place of `forward_generate` for single-token steps.
+
+    Buffers are viewed in buckets of `bucket_size` positions so that the traced
+    graph only ever sees a few shapes.
+    """
+    bucket_size = 32
+
+    def __init__(self, model: MemTransformerLM, traced: torch.jit.ScriptModule):
+        self.model = model
+        self.traced = traced
+
+    def get_capacity(self, mems: IncrementalMems) -> Optional[int]:
+        """
+        size of the buffer view for the next step, None when the step does not fit
+        (the memory would overflow `mem_len` or the buffers are not allocated yet)
+        """
+        mlen = len(mems)
+        if mlen + 1 > mems.mem_len:
+            return None
+        capacity = min(
+            (mlen // self.bucket_size + 1) * self.bucket_size, self.model.mem_len + self.model.tgt_len
+        )
+        for layer in mems.layers:
+            if layer.buffer is None:
+                return None
+            if layer.beg + capacity > layer.buffer.size(1):
+                layer._compact(capacity - mlen)
+            # slots past the window are masked out, but must not hold nan
+            layer.clear_until(layer.beg + capacity)
+        return capacity
+
+    def __call__(self, data: torch.Tensor, mems: IncrementalMems) -> Optional[torch.Tensor]:
+        """
+            data :: [1 x bsz]
+            returns logits :: [1 x bsz x n_token] and commits the token to `mems`,
+            or None when the step has to run through `forward_generate`
+        """
+        capacity = self.get_capacity(mems)
+        if capacity is None:
+            return None
+        pos = torch.tensor(len(mems), device=data.device)
+        kv_buffers = tuple(
+            layer.buffer[:, layer.beg: layer.beg + capacity] for layer in mems.layers
+        )
+        rel_keys = self.model._get_rel_key_table(capacity, kv_buffers[0])
+        logits = self.traced(data, pos, kv_buffers, rel_keys)
+        mems.commit(1)
+        return logits[None]
+
+
+def trace_decode_step(model: MemTransformerLM, bsz: int = 1) -> torch.jit.ScriptModule:
+    param = next(model.parameters())
+    capacity = CompiledDecodeStep.bucket_size
+    d = model.n_head * model.d_head
+    example_inputs = (
+        torch.zeros(1, bsz, dtype=torch.long, device=param.device),
+        torch.tensor(0, device=param.device),
+        tuple(
+            torch.zeros(2, capacity, bsz, d, device=param.device, dtype=param.dtype)
+            for _ in range(model.n_layer)
+        ),
+        model._get_rel_key_table(capacity, param),
+    )
+    with torch.no_grad():
+        traced = torch.jit.trace(DecodeStep(model).eval(), example_inputs, check_trace=False)
+    return traced
+
+
+def load_or_trace_decode_step(
+    model: MemTransformerLM, model_fp: Path, artifact_fp: Path
+) -> CompiledDecodeStep:
+    """
+    load the traced step cached at `artifact_fp`, tracing and saving it
+    when it is missing or older than the checkpoint `model_fp`
+    """
+    param = next(model.parameters())
+    if artifact_fp.exists() and artifact_fp.stat().st_mtime >= model_fp.stat().st_mtime:
+        traced = torch.jit.load(str(artifact_fp), map_location=param.device)
+    else:
+        traced = trace_decode_step(model)
+        torch.jit.save(traced, str(artifact_fp))
+    compiled = CompiledDecodeStep(model, traced)
+    _COMPILED_DECODE_STEPS[model] = compiled
+    return compiled
+
+
+# one compiled step per model, living as long as the model does
+_COMPILED_DECODE_STEPS = weakref.WeakKeyDictionary()
+
+
+def get_compiled_decode_step(model: MemTransformerLM) -> Optional[CompiledDecodeStep]:
+    return _COMPILED_DECODE_STEPS.get(model)
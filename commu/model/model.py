@@ -1,3 +1,5 @@
+from collections import OrderedDict
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -133,6 +135,164 @@ class ProjectedAdaptiveLogSoftmax(nn.Module):
         return nll
 
 
+class LayerKVCache:
+    """
+    Projected keys/values of one attention layer kept in a preallocated buffer.
+
+    The valid positions form a window `[beg, end)` that moves forward as tokens
+    are committed and old ones fall out of the memory. New keys/values are
+    written in place right after the window; once it reaches the end of the
+    buffer it is copied back to the front, so keeping the window contiguous
+    costs a constant amount of copying per token on average.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buffer = None
+        self.beg = 0
+        self.end = 0
+        # slots below max(end, cleared) hold written or zeroed values
+        self.cleared = 0
+
+    def __len__(self):
+        return self.end - self.beg
+
+    def extend(self, k, v):
+        """
+            k, v :: [qlen x bsz x n_head*d_head]
+            returns the cached keys/values followed by the new ones
+        """
+        qlen = k.size(0)
+        if self.buffer is None:
+            self.buffer = k.new_empty(2, max(self.capacity, qlen), k.size(1), k.size(2))
+            self.cleared = 0
+        elif self.end + qlen > self.buffer.size(1):
+            self._compact(qlen)
+
+        self.buffer[0, self.end: self.end + qlen] = k
+        self.buffer[1, self.end: self.end + qlen] = v
+        window = self.buffer[:, self.beg: self.end + qlen]
+        return window[0], window[1]
+
+    def _compact(self, qlen):
+        length = len(self)
+        if length + qlen > self.buffer.size(1):
+            buffer = self.buffer.new_empty(
+                2, max(2 * self.buffer.size(1), length + qlen), *self.buffer.shape[2:]
+            )
+        else:
+            buffer = self.buffer
+        window = self.buffer[:, self.beg: self.end]
+        if buffer is self.buffer and self.beg < length:
+            # source and destination overlap
+            window = window.clone()
+        buffer[:, :length] = window
+        self.buffer = buffer
+        self.beg, self.end = 0, length
+        self.cleared = length
+
+    def commit(self, qlen, mem_len):
+        self.end += qlen
+        self.beg = max(self.beg, self.end - mem_len)
+
+    def truncate(self, length):
+        self.cleared = max(self.cleared, self.end)
+        self.end = min(self.end, self.beg + length)
+
+    def clear_until(self, end):
+        """
+        zero the never written slots of the buffer below `end`,
+        so that a fixed-size view past the window only holds finite values
+        """
+        if self.cleared < end:
+            self.buffer[:, max(self.cleared, self.end): end].zero_()
+            self.cleared = end
+
+    def window(self):
+        return self.buffer[:, self.beg: self.end]
+
+    def load(self, window):
+        """
+            window :: [2 x mlen x bsz x n_head*d_head], copied into a new buffer
+        """
+        length = window.size(1)
+        self.buffer = window.new_empty(2, max(self.capacity, length), *window.shape[2:])
+        self.buffer[:, :length] = window
+        self.beg, self.end = 0, length
+        self.cleared = length
+
+    def select(self, indices):
+        if self.buffer is None:
+            return
+        length = len(self)
+        buffer = self.buffer.new_empty(2, self.buffer.size(1), len(indices), self.buffer.size(3))
+        buffer[:, :length] = self.buffer[:, self.beg: self.end].index_select(2, indices)
+        self.buffer = buffer
+        self.beg, self.end = 0, length
+        self.cleared = length
+
+
+class IncrementalMems:
+    """
+    Inference-only memory used by the incremental decode mode of
+    `MemTransformerLM.forward_generate`.
+
+    Instead of the hidden states fed to every layer it keeps their projected
+    keys and values, so a decode step only runs `qkv_net` over the new tokens.
+    It is updated in place by every forward pass, without reallocating the
+    memory on each step.
+    """
+
+    def __init__(self, n_layer, mem_len, capacity=None):
+        self.mem_len = mem_len
+        if capacity is None:
+            # pages of the buffer that are never written are never touched
+            capacity = 2 * mem_len
+        self.layers = [LayerKVCache(capacity) for _ in range(n_layer)]
+
+    def __len__(self):
+        return len(self.layers[0])
+
+    def commit(self, qlen):
+        """
+        make the `qlen` positions appended by the last forward part of the memory,
+        keeping only the latest `mem_len` ones
+        """
+        for layer in self.layers:
+            layer.commit(qlen, self.mem_len)
+
+    def truncate(self, length):
+        """
+        drop the most recent positions so that only the first `length` remain
+        """
+        for layer in self.layers:
+            layer.truncate(length)
+
+    def row_state(self, idx):
+        """
+        copy of the memory of one batch row, one [2 x mlen x 1 x d] tensor per layer
+        """
+        return [layer.window()[:, :, idx: idx + 1].clone() for layer in self.layers]
+
+    def load_rows(self, row_states):
+        """
+        fill the memory with one batch row per state returned by `row_state`,
+        the states must share the same length
+        """
+        for i, layer in enumerate(self.layers):
+            layer.load(torch.cat([state[i] for state in row_states], dim=2))
+
+    def select(self, indices):
+        """
+        keep the batch rows at `indices`, in that order (rows may be repeated)
+        """
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        for layer in self.layers:
+            if layer.buffer is not None:
+                indices = indices.to(layer.buffer.device)
+            layer.select(indices)
+
+
 class PositionalEmbedding(nn.Module):
     def __init__(self, demb):
         super(PositionalEmbedding, self).__init__()
@@ -277,19 +437,29 @@ class RelPartialLearnableMultiHeadAttn(RelMultiHeadAttn):
 
         self.r_net = nn.Linear(self.d_model, self.n_head * self.d_head, bias=False)
 
-    def forward(self, w, r, r_w_bias, r_r_bias, attn_mask=None, mems=None):
-        qlen, rlen, bsz = w.size(0), r.size(0), w.size(1)
+    def forward(
+            self, w, r, r_w_bias, r_r_bias, attn_mask=None, mems=None, kv_cache=None, r_head_k=None
+    ):
+        qlen, bsz = w.size(0), w.size(1)
+
+        if r_head_k is None:
+            r_head_k = self.r_net(r)
+        rlen = r_head_k.size(0)
 
-        if mems is not None:
+        if kv_cache is not None:
+            # only the new tokens are projected, past keys/values come from the cache
+            w_heads = self.qkv_net(w)
+
+            w_head_q, w_head_k, w_head_v = torch.chunk(w_heads, 3, dim=-1)
+            w_head_k, w_head_v = kv_cache.extend(w_head_k, w_head_v)
+        elif mems is not None:
             cat = torch.cat([mems, w], 0)
             w_heads = self.qkv_net(cat)
-            r_head_k = self.r_net(r)
 
             w_head_q, w_head_k, w_head_v = torch.chunk(w_heads, 3, dim=-1)
             w_head_q = w_head_q[-qlen:]
         else:
             w_heads = self.qkv_net(w)
-            r_head_k = self.r_net(r)
 
             w_head_q, w_head_k, w_head_v = torch.chunk(w_heads, 3, dim=-1)
 
@@ -367,9 +537,18 @@ class RelPartialLearnableDecoderLayer(nn.Module):
             d_model, d_inner, dropout
         )
 
-    def forward(self, dec_inp, r, r_w_bias, r_r_bias, dec_attn_mask=None, mems=None):
+    def forward(
+            self, dec_inp, r, r_w_bias, r_r_bias, dec_attn_mask=None, mems=None, kv_cache=None, r_head_k=None
+    ):
         output = self.dec_attn(
-            dec_inp, r, r_w_bias, r_r_bias, attn_mask=dec_attn_mask, mems=mems
+            dec_inp,
+            r,
+            r_w_bias,
+            r_r_bias,
+            attn_mask=dec_attn_mask,
+            mems=mems,
+            kv_cache=kv_cache,
+            r_head_k=r_head_k,
         )
 
         output = self.pos_ff(output)
@@ -421,6 +600,8 @@ class AdaptiveEmbedding(nn.Module):
 
 
 class MemTransformerLM(nn.Module):
+    attn_mask_cache_size = 16
+
     def __init__(
             self,
             cfg,
@@ -484,6 +665,8 @@ class MemTransformerLM(nn.Module):
         self.clamp_len = clamp_len
 
         self.detach_mems_grad = True
+        self._rel_key_table = None
+        self._attn_masks = OrderedDict()
         self._create_params()
 
     def _create_params(self):
@@ -494,6 +677,41 @@ class MemTransformerLM(nn.Module):
     def reset_length(self, tgt_len, mem_len):
         self.tgt_len = tgt_len
         self.mem_len = mem_len
+        self._attn_masks.clear()
+
+    def train(self, mode=True):
+        # weights may change from here on, the table is rebuilt on the next decode
+        self._rel_key_table = None
+        return super(MemTransformerLM, self).train(mode)
+
+    def _get_rel_key_table(self, klen, ref):
+        """
+        `r_net(pos_emb)` of every layer, precomputed for positions up to the
+        maximum key length so that incremental decode steps only slice it.
+        Rows are stored from the farthest position to position 0.
+            returns :: [n_layer x klen x n_head*d_head] for positions klen-1 .. 0
+        """
+        table = self._rel_key_table
+        if (
+                table is None
+                or table.size(1) < klen
+                or table.dtype != ref.dtype
+                or table.device != ref.device
+        ):
+            # grow geometrically up to the maximum key length of the decode mode
+            size = 128 if table is None else 2 * table.size(1)
+            size = max(klen, min(size, self.mem_len + self.tgt_len))
+            # positions stay in fp32, bf16 cannot represent them exactly
+            pos_seq = torch.arange(size - 1, -1, -1.0, device=ref.device)
+            if self.clamp_len > 0:
+                pos_seq.clamp_(max=self.clamp_len)
+            pos_emb = self.pos_emb(pos_seq)[:, 0].to(ref.dtype)
+            with torch.no_grad():
+                table = torch.stack(
+                    [layer.dec_attn.r_net(pos_emb) for layer in self.layers]
+                )
+            self._rel_key_table = table
+        return table[:, table.size(1) - klen:]
 
     def init_mems(self, n_layers):
         if self.mem_len > 0:
@@ -504,6 +722,49 @@ class MemTransformerLM(nn.Module):
         else:
             return None
 
+    def init_incremental_mems(self, capacity=None):
+        return IncrementalMems(self.n_layer, self.mem_len, capacity=capacity)
+
+    def _build_attn_mask(self, qlen, mlen, ref):
+        klen = mlen + qlen
+        all_ones = ref.new_ones(qlen, klen)
+        if self.same_length:
+            mask_len = klen - self.mem_len
+            if mask_len > 0:
+                mask_shift_len = qlen - mask_len
+            else:
+                mask_shift_len = qlen
+            dec_attn_mask = (
+                    torch.triu(all_ones, 1 + mlen) + torch.tril(all_ones, -mask_shift_len)
+            ).bool()
+        else:
+            dec_attn_mask = torch.triu(all_ones, diagonal=1 + mlen).bool()
+        return dec_attn_mask
+
+    def _get_attn_mask(self, qlen, mlen, bsz, ref):
+        """
+            returns :: [bsz x qlen x klen] mask of the keys hidden from each query,
+            or None when every key is visible
+        """
+        # a single new token sees the whole memory unless it overflows `mem_len`
+        if qlen == 1 and (not self.same_length or mlen + qlen <= self.mem_len):
+            return None
+        # prefills and chunks rarely repeat a shape and their masks are large, only the
+        # single-token mask of an overflowing memory is kept
+        if qlen > 1:
+            return self._build_attn_mask(qlen, mlen, ref)[None].expand(bsz, -1, -1)
+
+        key = (mlen, bsz, self.same_length, ref.device)
+        dec_attn_mask = self._attn_masks.get(key)
+        if dec_attn_mask is None:
+            dec_attn_mask = self._build_attn_mask(qlen, mlen, ref)[None].expand(bsz, -1, -1)
+            if len(self._attn_masks) >= self.attn_mask_cache_size:
+                self._attn_masks.popitem(last=False)
+            self._attn_masks[key] = dec_attn_mask
+        else:
+            self._attn_masks.move_to_end(key)
+        return dec_attn_mask
+
     def _update_mems(self, hids, mems, qlen, mlen, reset_mems=None):
 
         # The idea is that randomization from shuffling will have be equivalent to memory resetting
@@ -511,6 +772,11 @@ class MemTransformerLM(nn.Module):
         if mems is None:
             return None
 
+        if isinstance(mems, IncrementalMems):
+            # keys/values were already appended by every layer
+            mems.commit(qlen)
+            return mems
+
         assert len(hids) == len(mems)
         # mems is not the same as self.mem_len
 
@@ -542,53 +808,42 @@ class MemTransformerLM(nn.Module):
         qlen, bsz = dec_inp.size()[0], dec_inp.size()[1]
         word_emb = self.word_emb(dec_inp)
 
-        mlen = mems[0].size(0) if mems is not None else 0
+        incremental = isinstance(mems, IncrementalMems)
+        if incremental:
+            mlen = len(mems)
+        else:
+            mlen = mems[0].size(0) if mems is not None else 0
         klen = mlen + qlen
 
         # Generate the mask between query and all the keys
-        if self.same_length:
-            all_ones = word_emb.new_ones(qlen, klen)
-            mask_len = klen - self.mem_len
-            if mask_len > 0:
-                mask_shift_len = qlen - mask_len
-            else:
-                mask_shift_len = qlen
-
         if reset_mems is None:
-            indices = torch.BoolTensor(dec_inp.shape[1]).fill_(False)
-        else:
-            indices = reset_mems
-
-        if self.same_length:
-            dec_attn_mask = ((
-                                     torch.triu(all_ones, 1 + mlen)
-                                     + torch.tril(all_ones, -mask_shift_len)
-                             ).bool()[
-                             :, :
-                             ]).repeat(len(indices), 1, 1)  # -1
+            dec_attn_mask = self._get_attn_mask(qlen, mlen, bsz, word_emb)
         else:
-            dec_attn_mask = (torch.triu(
-                word_emb.new_ones(qlen, klen), diagonal=1 + mlen
-            ).bool()[:, :]).repeat(len(indices), 1, 1)
-
-        dec_attn_mask[indices, :, :mlen] = 1
-
+            dec_attn_mask = self._build_attn_mask(qlen, mlen, word_emb).repeat(
+                len(reset_mems), 1, 1
+            )
+            dec_attn_mask[reset_mems, :, :mlen] = 1
 
         hids = []
-        pos_seq = torch.arange(
-            klen - 1, -1, -1.0, device=word_emb.device, dtype=word_emb.dtype
-        )
-        if self.clamp_len > 0:
-            pos_seq.clamp_(max=self.clamp_len)
-        pos_emb = self.pos_emb(pos_seq)
+        if incremental:
+            # projected positional keys are sliced from the precomputed table
+            pos_emb = None
+            rel_keys = self._get_rel_key_table(klen, word_emb)
+        else:
+            pos_seq = torch.arange(klen - 1, -1, -1.0, device=word_emb.device)
+            if self.clamp_len > 0:
+                pos_seq.clamp_(max=self.clamp_len)
+            pos_emb = self.pos_emb(pos_seq).to(word_emb.dtype)
+            pos_emb = self.drop(pos_emb)
 
         core_out = self.drop(word_emb)
-        pos_emb = self.drop(pos_emb)
 
         hids.append(core_out)
 
         for i, layer in enumerate(self.layers):
-            mems_i = None if mems is None else mems[i]
+            mems_i = None if mems is None or incremental else mems[i]
+            kv_cache_i = mems.layers[i] if incremental else None
+            r_head_k_i = rel_keys[i] if incremental else None
             core_out = layer(
                 core_out,
                 pos_emb,
@@ -596,17 +851,27 @@ class MemTransformerLM(nn.Module):
                 self.r_r_bias,
                 dec_attn_mask=dec_attn_mask,
                 mems=mems_i,
+                kv_cache=kv_cache_i,
+                r_head_k=r_head_k_i,
             )
             hids.append(core_out)
         core_out = self.drop(core_out)
 
-        new_mems = self._update_mems(hids, mems, mlen, qlen, reset_mems)
+        new_mems = self._update_mems(hids, mems, qlen, mlen, reset_mems)
         return core_out, new_mems
 
-    def forward_generate(self, data, mems):
+    def forward_generate(self, data, mems, incremental=False):
+        """
+            data :: [len x bsz]
+            with `incremental` (or when `mems` is an `IncrementalMems`) projected
+            keys/values are cached and `mems` is updated in place
+        """
 
         if mems is None:
-            mems = self.init_mems(self.n_layer)
+            if incremental:
+                mems = self.init_incremental_mems()
+            else:
+                mems = self.init_mems(self.n_layer)
 
         tgt_len = data.size(0)
         batch_size = data.size(1)
@@ -614,19 +879,35 @@ class MemTransformerLM(nn.Module):
         hidden, new_mems = self._forward(data, None, mems=mems)
 
         pred_hid = hidden[-tgt_len:]
-
-        assert self.crit.n_clusters == 0
-
-        logits = self.crit._compute_logit(
-            pred_hid.view(-1, pred_hid.size(-1)),
-            self.crit.out_layers[0].weight,
-            self.crit.out_layers[0].bias,
-            self.crit.out_projs[0],
-        )
+        logits = self._project_logits(pred_hid.reshape(-1, pred_hid.size(-1)))
         logits = logits.view(tgt_len, batch_size, -1)
 
         return (logits, new_mems)
 
+    def prefill(self, data, mems=None, return_logits=False):
+        """
+            data :: [len x bsz] fed into an incremental memory, a new one when `mems` is None
+            returns the logits after the last token :: [bsz x n_token] (None without `return_logits`)
+            and the memory, only the last position is projected onto the vocabulary
+        """
+        if mems is None:
+            mems = self.init_incremental_mems()
+        hidden, new_mems = self._forward(data, None, mems=mems)
+        logits = self._project_logits(hidden[-1]) if return_logits else None
+        return logits, new_mems
+
+    def _project_logits(self, pred_hid):
+        """
+            pred_hid :: [n x d_model]
+            returns :: [n x n_token]
+        """
+        assert self.crit.n_clusters == 0
+
+        # the output layer is called as a module so that it can be swapped for a quantized one
+        if self.crit.out_projs[0] is not None:
+            pred_hid = F.linear(pred_hid, self.crit.out_projs[0].t().contiguous())
+        return self.crit.out_layers[0](pred_hid)
+
     def forward_generate_gumbel(self, data, temperature, mems):
 
         from torch.autograd import Variable
@@ -0,0 +1,185 @@
+import inspect
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from commu.model.model import MemTransformerLM
+
+
+class OnnxDecoder(nn.Module):
+    """
+    `MemTransformerLM` inference with the memory as explicit inputs/outputs, for the ONNX export,
+    of a model set up for inference with `same_length` as `ModelInitializeTask` does.
+
+    The memory holds the projected keys/values of every layer,
+        mems :: [mlen x n_layer x 2 x bsz x n_head*d_head]
+    and every call returns the keys/values of the tokens it was fed, which the
+    runtime appends to it. Without `mems` the relative positional keys are
+    computed on the fly (prefill), otherwise they are sliced from a table
+    precomputed for every position up to `mem_len + tgt_len` (decode).
+    """
+
+    def __init__(self, model: MemTransformerLM, with_mems: bool):
+        super(OnnxDecoder, self).__init__()
+        if not model.same_length:
+            raise ValueError("only a model set up with same_length is exported")
+        self.model = model
+        self.with_mems = with_mems
+        if with_mems:
+            klen = model.mem_len + model.tgt_len
+            self.register_buffer(
+                "rel_key_table", model._get_rel_key_table(klen, model.r_w_bias).clone()
+            )
+
+    def forward(self, data, mems=None):
+        """
+            data :: [qlen x bsz]
+            returns logits of the last token :: [bsz x n_token]
+            and keys/values of the fed tokens :: [qlen x n_layer x 2 x bsz x n_head*d_head]
+        """
+        model = self.model
+        n_head, d_head = model.n_head, model.d_head
+        qlen, bsz = data.size(0), data.size(1)
+        mlen = mems.size(0) if mems is not None else 0
+        klen = mlen + qlen
+
+        # the `same_length` mask of the torch model: every query attends to its latest `mem_len` keys
+        key_pos = torch.arange(klen, device=data.device)[None, :]
+        query_pos = torch.arange(qlen, device=data.device)[:, None] + mlen
+        attn_mask = (key_pos > query_pos) | (key_pos <= query_pos - model.mem_len)
+        attn_mask = attn_mask[None, None, :, :]
+
+        if self.with_mems:
+            # a chunk fed after a full memory has keys past the end of the table,
+            # they are farther than `mem_len` and masked, so the farthest row stands in for them
+            rel_key_table = torch.cat(
+                [self.rel_key_table[:, :1].expand(-1, qlen, -1), self.rel_key_table], 1
+            )
+            rel_keys = rel_key_table[:, rel_key_table.size(1) - klen:]
+        else:
+            pos_seq = torch.arange(klen - 1, -1, -1.0, device=data.device)
+            if model.clamp_len > 0:
+                pos_seq = pos_seq.clamp(max=model.clamp_len)
+            inv_freq = model.pos_emb.inv_freq
+            sinusoid_inp = pos_seq[:, None] * inv_freq[None, :]
+            pos_emb = torch.cat([sinusoid_inp.sin(), sinusoid_inp.cos()], dim=-1)
+
+        core_out = model.word_emb(data)
+        new_kv = []
+        for i, layer in enumerate(model.layers):
+            attn = layer.dec_attn
+            w_head_q, w_head_k, w_head_v = torch.chunk(attn.qkv_net(core_out), 3, dim=-1)
+            new_kv.append(torch.stack([w_head_k, w_head_v], dim=1))
+            if mems is not None:
+                w_head_k = torch.cat([mems[:, i, 0], w_head_k], 0)
+                w_head_v = torch.cat([mems[:, i, 1], w_head_v], 0)
+            r_head_k = rel_keys[i] if self.with_mems else attn.r_net(pos_emb)
+
+            w_head_q = w_head_q.view(qlen, bsz, n_head, d_head)
+            w_head_k = w_head_k.view(klen, bsz, n_head, d_head)
+            w_head_v = w_head_v.view(klen, bsz, n_head, d_head)
+            r_head_k = r_head_k.view(klen, n_head, d_head)
+
+            AC = torch.einsum("ibnd,jbnd->bnij", (w_head_q + model.r_w_bias, w_head_k))
+            BD = torch.einsum("ibnd,jnd->bnij", (w_head_q + model.r_r_bias, r_head_k))
+            BD = attn._rel_shift(BD)
+            attn_score = (AC + BD) * attn.scale
+            attn_score = attn_score.masked_fill(attn_mask, -float("inf"))
+            attn_prob = F.softmax(attn_score, dim=3)
+
+            attn_vec = torch.einsum("bnij,jbnd->ibnd", (attn_prob, w_head_v))
+            attn_vec = attn_vec.reshape(qlen, bsz, n_head * d_head)
+            core_out = attn.layer_norm(core_out + attn.o_net(attn_vec))
+            core_out = layer.pos_ff(core_out)
+
+        pred_hid = core_out[-1]
+        if model.crit.out_projs[0] is not None:
+            pred_hid = F.linear(pred_hid, model.crit.out_projs[0].t().contiguous())
+        logits = model.crit.out_layers[0](pred_hid)
+        return logits, torch.stack(new_kv, dim=1)
+
+
+def export_onnx(
+    model: MemTransformerLM, prefill_fp: Path, decode_fp: Path, opset_version: int = 17
+) -> None:
+    """
+    write the prefill (tokens only) and the decode (tokens and memory) graphs of an fp32 model
+    """
+    param = next(model.parameters())
+    kv_dim = model.n_head * model.d_head
+    data = torch.zeros(2, 1, dtype=torch.long, device=param.device)
+    mems = torch.zeros(3, model.n_layer, 2, 1, kv_dim, device=param.device)
+    export_kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        export_kwargs["dynamo"] = False
+
+    with torch.no_grad():
+        torch.onnx.export(
+            OnnxDecoder(model, with_mems=False).eval(),
+            (data,),
+            str(prefill_fp),
+            input_names=["data"],
+            output_names=["logits", "new_kv"],
+            dynamic_axes={
+                "data": {0: "qlen", 1: "bsz"},
+                "logits": {0: "bsz"},
+                "new_kv": {0: "qlen", 3: "bsz"},
+            },
+            opset_version=opset_version,
+            **export_kwargs,
+        )
+        torch.onnx.export(
+            OnnxDecoder(model, with_mems=True).eval(),
+            (data, mems),
+            str(decode_fp),
+            input_names=["data", "mems"],
+            output_names=["logits", "new_kv"],
+            dynamic_axes={
+                "data": {0: "qlen", 1: "bsz"},
+                "mems": {0: "mlen", 3: "bsz"},
+                "logits": {0: "bsz"},
+                "new_kv": {0: "qlen", 3: "bsz"},
+            },
+            opset_version=opset_version,
+            **export_kwargs,
+        )
+
+
+def compare_onnx_logits(
+    model: MemTransformerLM,
+    decoder,
+    sequences: List[List[int]],
+    prefill_len: int,
+    chunk_len: int = 1,
+) -> Dict[str, float]:
+    """
+    parity check of an onnxruntime decoder against `forward_generate`:
+    prefill `prefill_len` tokens of every sequence, then feed the rest `chunk_len` tokens at a time
+    returns the largest difference of the logits after every chunk
+    and the ratio of chunks where the argmax agrees
+    """
+    max_diff, num_agree, num_steps = 0.0, 0, 0
+    param = next(model.parameters())
+    with torch.no_grad():
+        for seq in sequences:
+            data = torch.tensor(seq, dtype=torch.long, device=param.device)[:, None]
+            ctx = np.array(seq, dtype=np.int64)[:, None]
+            logits, mems = model.forward_generate(data[:prefill_len], mems=None, incremental=True)
+            onnx_logits, onnx_mems = decoder.forward(ctx[:prefill_len], None)
+            steps = [(logits[-1], onnx_logits)]
+            for idx in range(prefill_len, len(seq), chunk_len):
+                logits, mems = model.forward_generate(data[idx: idx + chunk_len], mems)
+                onnx_logits, onnx_mems = decoder.forward(ctx[idx: idx + chunk_len], onnx_mems)
+                steps.append((logits[-1], onnx_logits))
+
+            for torch_logits, onnx_logits in steps:
+                torch_logits = torch_logits.cpu().numpy()
+                max_diff = max(max_diff, float(np.abs(torch_logits - onnx_logits).max()))
+                num_agree += int((torch_logits.argmax(-1) == onnx_logits.argmax(-1)).sum())
+                num_steps += torch_logits.shape[0]
+
+    return {"max_logits_diff": max_diff, "argmax_agreement": num_agree / num_steps}
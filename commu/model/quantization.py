@@ -0,0 +1,75 @@
+from typing import Dict, List
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from commu.model.model import MemTransformerLM
+
+
+def quantize_dynamic_int8(model: MemTransformerLM) -> MemTransformerLM:
+    """
+    copy of an eval-mode model whose linear layers (`qkv_net`, `r_net`, `o_net`,
+    the position-wise feed-forward and the output layer) run with dynamic int8 weights
+    only meant for inference on CPU
+    """
+    quantized = torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    quantized.eval()
+    return quantized
+
+
+def bfloat16_supported() -> bool:
+    """
+    whether the CPU runs bf16 matmuls natively (avx512_bf16 / amx) instead of emulating them
+    """
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def cast_bfloat16(model: MemTransformerLM) -> MemTransformerLM:
+    """
+    cast the weights of an eval-mode model to bf16, in place, so that its
+    incremental memory is allocated in bf16 too
+    the sinusoid frequencies stay in fp32, positional embeddings are computed
+    in fp32 and cast afterwards
+    """
+    inv_freq = model.pos_emb.inv_freq
+    model.to(torch.bfloat16)
+    model.pos_emb.inv_freq = inv_freq
+    return model
+
+
+def compare_token_distributions(
+    reference: MemTransformerLM,
+    candidate: MemTransformerLM,
+    sequences: List[List[int]],
+    device: torch.device,
+) -> Dict[str, float]:
+    """
+    feed the same token sequences to both models and compare their next token distributions
+    returns the mean KL divergence of the candidate from the reference, the largest
+    probability difference and the ratio of positions where the most probable tokens agree
+    """
+    kl_sum, max_prob_diff, num_agree, num_positions = 0.0, 0.0, 0, 0
+    with torch.no_grad():
+        for seq in sequences:
+            data = torch.tensor(seq, dtype=torch.long, device=device)[:, None]
+            ref_logits, _ = reference.forward_generate(data, mems=None, incremental=True)
+            cand_logits, _ = candidate.forward_generate(data, mems=None, incremental=True)
+            ref_log_probs = F.log_softmax(ref_logits[:, 0, 1:].float(), dim=-1)
+            cand_log_probs = F.log_softmax(cand_logits[:, 0, 1:].float(), dim=-1)
+
+            kl = (ref_log_probs.exp() * (ref_log_probs - cand_log_probs)).sum(dim=-1)
+            prob_diff = (ref_log_probs.exp() - cand_log_probs.exp()).abs().max()
+            kl_sum += float(kl.sum())
+            max_prob_diff = max(max_prob_diff, float(prob_diff))
+            num_agree += int((ref_log_probs.argmax(-1) == cand_log_probs.argmax(-1)).sum())
+            num_positions += len(seq)
+
+    return {
+        "mean_kl": kl_sum / num_positions,
+        "max_prob_diff": max_prob_diff,
+        "top1_agreement": num_agree / num_positions,
+    }
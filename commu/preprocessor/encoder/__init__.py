@@ -1,3 +1,4 @@
 from .encoder import *
 from .meta import MetaEncoder
+from .vocab import Vocabulary, get_vocabulary
 from . import event_tokens
\ No newline at end of file
@@ -5,6 +5,7 @@ import numpy as np
 
 from . import encoder_utils
 from .event_tokens import TOKEN_OFFSET
+from .vocab import get_vocabulary
 from ..utils.constants import (
     DEFAULT_POSITION_RESOLUTION,
     DEFAULT_TICKS_PER_BEAT,
@@ -13,11 +14,17 @@ from ..utils.constants import (
 
 class EventSequenceEncoder:
     def __init__(self):
-        self.event2word, self.word2event = encoder_utils.mk_remi_map()
-        self.event2word = encoder_utils.add_flat_chord2map(self.event2word)
-        self.event2word = encoder_utils.abstract_chord_types(self.event2word)
+        self.vocabulary = get_vocabulary()
         self.position_resolution = DEFAULT_POSITION_RESOLUTION
 
+    @property
+    def event2word(self):
+        return self.vocabulary.event2word
+
+    @property
+    def word2event(self):
+        return self.vocabulary.word2event
+
     def encode(self, midi_paths, sample_info=None, for_cp=False):
         midi_file = miditoolkit.MidiFile(midi_paths)
         ticks_per_beat = midi_file.ticks_per_beat
@@ -89,7 +96,7 @@ class EventSequenceEncoder:
 
         decoded_midi = encoder_utils.write_midi(
             midi_info,
-            self.word2event,
+            self.vocabulary,
             duration_bins=duration_bins,
             beats_per_bar=beats_per_bar,
         )
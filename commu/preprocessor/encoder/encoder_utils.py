@@ -1,10 +1,11 @@
 import copy
+import functools
 from typing import Dict
 
 import miditoolkit
 import numpy as np
 
-from .event_tokens import base_event, TOKEN_OFFSET
+from .event_tokens import base_event, EVENT_KIND, TOKEN_OFFSET
 from ..utils.constants import (
     BPM_INTERVAL,
     DEFAULT_POSITION_RESOLUTION,
@@ -15,21 +16,7 @@ from ..utils.constants import (
 )
 
 NUM_VELOCITY_BINS = int(128 / VELOCITY_INTERVAL)
-DEFAULT_VELOCITY_BINS = np.linspace(2, 127, NUM_VELOCITY_BINS, dtype=np.int)
-
-class Item(object):
-    def __init__(self, name, start, end, velocity, pitch):
-        self.name = name
-        self.start = start
-        self.end = end
-        self.velocity = velocity
-        self.pitch = pitch
-
-    def __repr__(self):
-        return "Item(name={}, start={}, end={}, velocity={}, pitch={})".format(
-            self.name, self.start, self.end, self.velocity, self.pitch
-        )
-
+DEFAULT_VELOCITY_BINS = np.linspace(2, 127, NUM_VELOCITY_BINS, dtype=int)
 
 class Event(object):
     def __init__(self, name, time, value, text):
@@ -190,14 +177,12 @@ def extract_events(
     num_measures=None,
     is_incomplete_measure=None,
 ):
-    note_items = read_items(input_path)
-    max_time = note_items[-1].end
+    notes = read_note_array(input_path)
+    max_time = notes[-1, 1]
     if not chord_progression[0]:
         return None
-    else:
-        items = note_items
-    groups = group_items(items, max_time, ticks_per_bar)
-    events = item2event(groups, duration_bins)
+    quantized = quantize_notes(notes, max_time, ticks_per_bar, duration_bins)
+    events = note_array2event(quantized, duration_bins)
     beats_per_bar = int(ticks_per_bar/ticks_per_beat)
 
     if chord_progression:
@@ -213,103 +198,86 @@ def extract_events(
 
     return events
 
-def read_items(file_path):
+def read_note_array(file_path):
+    """
+    notes :: [n x 4] (start, end, velocity, pitch) of the first instrument, sorted by start then pitch
+    """
     midi_obj = miditoolkit.midi.parser.MidiFile(file_path)
-    note_items = []
-    notes = midi_obj.instruments[0].notes
-    notes.sort(key=lambda x: (x.start, x.pitch))
-    for note in notes:
-        note_items.append(
-            Item(
-                name="Note",
-                start=note.start,
-                end=note.end,
-                velocity=note.velocity,
-                pitch=note.pitch,
-            )
-        )
-    note_items.sort(key=lambda x: x.start)
-    return note_items
-
-def group_items(items, max_time, ticks_per_bar):
-    items.sort(key=lambda x: x.start)
+    notes = np.array(
+        [[note.start, note.end, note.velocity, note.pitch] for note in midi_obj.instruments[0].notes],
+        dtype=np.int64,
+    ).reshape(-1, 4)
+    return notes[np.lexsort((notes[:, 3], notes[:, 0]))]
+
+def quantize_notes(notes, max_time, ticks_per_bar, duration_bins):
+    """
+    position, velocity and duration bins of every note at once
+    returns the notes starting within a bar :: [n x 8]
+    (start, bar, position, velocity, velocity bin, pitch, duration, duration bin)
+    """
     downbeats = np.arange(0, max_time + ticks_per_bar, ticks_per_bar)
-    groups = []
-    for db1, db2 in zip(downbeats[:-1], downbeats[1:]):
-        insiders = []
-        for item in items:
-            if (item.start >= db1) and (item.start < db2):
-                insiders.append(item)
-        if not insiders:
-            insiders.append(Item(name="None", start=None, end=None, velocity=None, pitch="NN"))
-        overall = [db1] + insiders + [db2]
-        groups.append(overall)
-    return groups
-
-def item2event(groups, duration_bins):
+    start, end, velocity, pitch = notes.T
+    bar = start // ticks_per_bar
+    kept = (start >= 0) & (bar < len(downbeats) - 1)
+    start, end, velocity, pitch, bar = start[kept], end[kept], velocity[kept], pitch[kept], bar[kept]
+
+    # nearest of the flags of every bar, the lower one on ties as np.argmin picks
+    flags = np.linspace(
+        downbeats[:-1], downbeats[1:], DEFAULT_POSITION_RESOLUTION, endpoint=False, axis=-1
+    )
+    position = nearest_index(flags, bar, start)
+    velocity_index = np.searchsorted(DEFAULT_VELOCITY_BINS, velocity, side="right") - 1
+    duration = end - start
+    duration_index = nearest_index(np.asarray(duration_bins)[None], 0, duration)
+    return np.stack(
+        [start, bar, position, velocity, velocity_index, pitch, duration, duration_index], axis=1
+    )
+
+def nearest_index(rows, row_index, values):
+    """
+    index of the element nearest to each value in its row of `rows`,
+    the rows being ascending one after the other once flattened
+    """
+    num_cols = rows.shape[1]
+    flat = rows.ravel()
+    upper = np.searchsorted(flat, values, side="left") - row_index * num_cols
+    lower = np.clip(upper - 1, 0, num_cols - 1) + row_index * num_cols
+    upper = np.clip(upper, 0, num_cols - 1) + row_index * num_cols
+    lower_dist = np.abs(flat[lower] - values)
+    upper_dist = np.abs(flat[upper] - values)
+    return np.where(lower_dist <= upper_dist, lower, upper) - row_index * num_cols
+
+def note_array2event(quantized, duration_bins):
+    """
+    Position, Note Velocity, Note On and Note Duration events of the notes of `quantize_notes`
+    """
     events = []
-    n_downbeat = 0
-    for i in range(len(groups)):
-        if "NN" in [item.pitch for item in groups[i][1:-1]]:
-            continue
-        bar_st, bar_et = groups[i][0], groups[i][-1]
-        n_downbeat += 1
-        if groups[i][1].name == "Chord":
-            events.append(Event(name="Bar", time=bar_st, value=None, text="{}".format(n_downbeat)))
-        for item in groups[i][1:-1]:
-            # position
-            flags = np.linspace(bar_st, bar_et, DEFAULT_POSITION_RESOLUTION, endpoint=False)
-            index = np.argmin(abs(flags - item.start))
-            events.append(
-                Event(
-                    name="Position",
-                    time=item.start,
-                    value="{}/{}".format(index + 1, DEFAULT_POSITION_RESOLUTION),
-                    text="{}".format(item.start),
-                )
+    for start, _, position, velocity, velocity_index, pitch, duration, duration_index in quantized.tolist():
+        events.append(
+            Event(
+                name="Position",
+                time=start,
+                value="{}/{}".format(position + 1, DEFAULT_POSITION_RESOLUTION),
+                text="{}".format(start),
             )
-            if item.name == "Note":
-                # velocity
-                velocity_index = (
-                    np.searchsorted(DEFAULT_VELOCITY_BINS, item.velocity, side="right") - 1
-                )
-                events.append(
-                    Event(
-                        name="Note Velocity",
-                        time=item.start,
-                        value=velocity_index,
-                        text="{}/{}".format(item.velocity, DEFAULT_VELOCITY_BINS[velocity_index]),
-                    )
-                )
-                # pitch
-                events.append(
-                    Event(
-                        name="Note On",
-                        time=item.start,
-                        value=item.pitch,
-                        text="{}".format(item.pitch),
-                    )
-                )
-                # duration
-                duration = item.end - item.start
-                index = np.argmin(abs(duration_bins - duration))
-                events.append(
-                    Event(
-                        name="Note Duration",
-                        time=item.start,
-                        value=index,
-                        text="{}/{}".format(duration, duration_bins[index]),
-                    )
-                )
-            elif item.name == "Chord":
-                events.append(
-                    Event(
-                        name="Chord",
-                        time=item.start,
-                        value=item.pitch,
-                        text="{}".format(item.pitch),
-                    )
-                )
+        )
+        events.append(
+            Event(
+                name="Note Velocity",
+                time=start,
+                value=velocity_index,
+                text="{}/{}".format(velocity, DEFAULT_VELOCITY_BINS[velocity_index]),
+            )
+        )
+        events.append(Event(name="Note On", time=start, value=pitch, text="{}".format(pitch)))
+        events.append(
+            Event(
+                name="Note Duration",
+                time=start,
+                value=duration_index,
+                text="{}/{}".format(duration, duration_bins[duration_index]),
+            )
+        )
     return events
 
 def insert_chord_on_event(
@@ -367,97 +335,87 @@ def detect_chord(chord_progression, beats_per_bar):
                 chord_name.append(chord)
     return chord_idx, chord_name
 
-def word_to_event(words, word2event):
-    events = []
-    for word in words:
-        try:
-            event_name, event_value = word2event[word].split("_")
-        except KeyError:
-            if word == 1:
-                # 따로 디코딩 되지 않는 EOS
-                continue
-            else:
-                print(f"OOV: {word}")
-            continue
-        events.append(Event(event_name, None, event_value, None))
-    return events
+def decode_words(words, vocabulary):
+    """
+    notes :: [n x 5] (bar, position, velocity bin, pitch, duration bin)
+    and chords :: [n x 3] (bar, position, index in `vocabulary.chord_names`)
+    read from the word sequence through the lookup tables of `vocabulary`,
+    words outside of the vocabulary and EOS are left out
+    """
+    words = np.asarray(words, dtype=np.int64)
+    in_vocab = (words >= 0) & (words < len(vocabulary.kinds))
+    kinds = np.full(len(words), EVENT_KIND.NONE, dtype=np.int64)
+    kinds[in_vocab] = vocabulary.kinds[words[in_vocab]]
+    decoded = kinds != EVENT_KIND.NONE
+    for word in words[~decoded & (words != TOKEN_OFFSET.EOS.value)]:
+        print(f"OOV: {word}")
+    words, kinds = words[decoded], kinds[decoded]
+    values = vocabulary.values[words]
+
+    # the last three events never start a group
+    n = max(len(kinds) - 3, 0)
+    is_bar = kinds[:n] == EVENT_KIND.BAR
+    # the first event is never counted as a bar
+    is_bar[:1] = False
+    bars = np.cumsum(is_bar)
+    is_position = kinds[:n] == EVENT_KIND.POSITION
+    is_note = (
+        is_position
+        & (kinds[1: n + 1] == EVENT_KIND.NOTE_VELOCITY)
+        & (kinds[2: n + 2] == EVENT_KIND.NOTE_ON)
+        & (kinds[3: n + 3] == EVENT_KIND.NOTE_DURATION)
+    )
+    is_chord = is_position & (kinds[1: n + 1] == EVENT_KIND.CHORD)
+
+    idx = np.flatnonzero(is_note)
+    notes = np.stack([bars[idx], values[idx], values[idx + 1], values[idx + 2], values[idx + 3]], axis=1)
+    idx = np.flatnonzero(is_chord)
+    chords = np.stack([bars[idx], values[idx], values[idx + 1]], axis=1)
+    return notes, chords
+
+@functools.lru_cache(maxsize=None)
+def get_position_ticks(ticks_per_bar):
+    """
+    tick offset of every position from the start of its bar,
+    the flags `np.linspace(bar_st, bar_et, DEFAULT_POSITION_RESOLUTION, endpoint=False)` of bar 0
+    """
+    position_ticks = np.linspace(
+        0, ticks_per_bar, DEFAULT_POSITION_RESOLUTION, endpoint=False, dtype=int
+    )
+    position_ticks.setflags(write=False)
+    return position_ticks
+
+def make_notes(temp_notes, ticks_per_bar, duration_bins):
+    """
+    timed notes of the (bar, position, velocity bin, pitch, duration bin) rows of `decode_words`
+    """
+    bar, position, velocity_index, pitch, duration_index = np.asarray(temp_notes).reshape(-1, 5).T
+    st = bar * ticks_per_bar + get_position_ticks(ticks_per_bar)[position]
+    et = st + duration_bins[duration_index]
+    velocity = DEFAULT_VELOCITY_BINS[velocity_index]
+    return [
+        miditoolkit.Note(*note)
+        for note in zip(velocity.tolist(), pitch.tolist(), st.tolist(), et.tolist())
+    ]
 
 def write_midi(
     midi_info,
-    word2event,
+    vocabulary,
     duration_bins,
     beats_per_bar,
 ):
-    events = word_to_event(midi_info.event_seq, word2event)
-    # get downbeat and note (no time)
-    temp_notes = []
-    temp_chords = []
-    for i in range(len(events) - 3):
-        if events[i].name == "Bar" and i > 0:
-            temp_notes.append("Bar")
-            temp_chords.append("Bar")
-        elif (
-            events[i].name == "Position"
-            and events[i + 1].name == "Note Velocity"
-            and events[i + 2].name == "Note On"
-            and events[i + 3].name == "Note Duration"
-        ):
-            # start time and end time from position
-            position = int(events[i].value.split("/")[0]) - 1
-            # velocity
-            index = int(events[i + 1].value)
-            velocity = int(DEFAULT_VELOCITY_BINS[index])
-            # pitch
-            pitch = int(events[i + 2].value)
-            # duration
-            index = int(events[i + 3].value)
-            duration = duration_bins[index]
-            # adding
-            temp_notes.append([position, velocity, pitch, duration])
-        elif events[i].name == "Position" and events[i + 1].name == "Chord":
-            position = int(events[i].value.split("/")[0]) - 1
-            temp_chords.append([position, events[i + 1].value])
-    # get specific time for notes
+    temp_notes, temp_chords = decode_words(midi_info.event_seq, vocabulary)
     ticks_per_beat = DEFAULT_TICKS_PER_BEAT
     ticks_per_bar = ticks_per_beat * beats_per_bar
-    notes = []
-    current_bar = 0
-    for note in temp_notes:
-        if note == "Bar":
-            current_bar += 1
-        else:
-            position, velocity, pitch, duration = note
-            # position (start time)
-            current_bar_st = current_bar * ticks_per_bar
-            current_bar_et = (current_bar + 1) * ticks_per_bar
-            flags = np.linspace(
-                int(current_bar_st),
-                int(current_bar_et),
-                int(DEFAULT_POSITION_RESOLUTION),
-                endpoint=False,
-                dtype=int,
-            )
-            st = flags[position]
-            # duration (end time)
-            et = st + duration
-            notes.append(miditoolkit.Note(velocity, pitch, st, et))
+    position_ticks = get_position_ticks(ticks_per_bar)
+    # get specific time for notes
+    notes = make_notes(temp_notes, ticks_per_bar, duration_bins)
     # get specific time for chords
-    if len(temp_chords) > 0:
-        chords = []
-        current_bar = 0
-        for chord in temp_chords:
-            if chord == "Bar":
-                current_bar += 1
-            else:
-                position, value = chord
-                # position (start time)
-                current_bar_st = current_bar * ticks_per_bar
-                current_bar_et = (current_bar + 1) * ticks_per_bar
-                flags = np.linspace(
-                    current_bar_st, current_bar_et, DEFAULT_POSITION_RESOLUTION, endpoint=False, dtype=int
-                )
-                st = flags[position]
-                chords.append([st, value])
+    bar, position, chord_index = temp_chords.T
+    st = bar * ticks_per_bar + position_ticks[position]
+    chords = [
+        [chord_st, vocabulary.chord_names[idx]] for chord_st, idx in zip(st.tolist(), chord_index.tolist())
+    ]
 
     midi = miditoolkit.midi.parser.MidiFile()
     numerator, denominator = SIG_TIME_MAP[
@@ -490,8 +448,7 @@ def write_midi(
     midi.tempo_changes = tempo_changes
 
     # write chord into marker
-    if len(temp_chords) > 0:
-        for c in chords:
-            midi.markers.append(miditoolkit.midi.containers.Marker(text=c[1], time=c[0]))
+    for c in chords:
+        midi.markers.append(miditoolkit.midi.containers.Marker(text=c[1], time=c[0]))
 
     return midi
@@ -327,3 +327,14 @@ class TOKEN_OFFSET(enum.Enum):
     REMI_META_OFFSET = 138
     META_CC_OFFSET = 7
     VOCAB_SIZE = 729
+
+
+class EVENT_KIND(enum.IntEnum):
+    # kind of the event of a word, NONE for the words `decode_words` leaves out
+    NONE = 0
+    BAR = 1
+    NOTE_ON = 2
+    NOTE_VELOCITY = 3
+    CHORD = 4
+    NOTE_DURATION = 5
+    POSITION = 6
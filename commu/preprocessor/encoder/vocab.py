@@ -0,0 +1,72 @@
+import functools
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Mapping, Tuple
+
+import numpy as np
+
+from . import encoder_utils
+from .event_tokens import EVENT_KIND, TOKEN_OFFSET
+
+EVENT_NAME_TO_KIND = {
+    "Bar": EVENT_KIND.BAR,
+    "Note On": EVENT_KIND.NOTE_ON,
+    "Note Velocity": EVENT_KIND.NOTE_VELOCITY,
+    "Chord": EVENT_KIND.CHORD,
+    "Note Duration": EVENT_KIND.NOTE_DURATION,
+    "Position": EVENT_KIND.POSITION,
+}
+
+
+@dataclass(frozen=True, eq=False)
+class Vocabulary:
+    """
+    event <-> word tables of the REMI events, shared read-only by every encoder/decoder
+
+    `event2word` also holds the flat and abstracted chord names,
+    which map onto the words of the chords they are folded into
+    """
+    event2word: Mapping[str, int]
+    word2event: Mapping[int, str]
+    # word -> EVENT_KIND and word -> int value of the event, over the whole vocab
+    # (0-based position, velocity bin, pitch, duration bin, index in `chord_names`)
+    kinds: np.ndarray
+    values: np.ndarray
+    chord_names: Tuple[str, ...]
+
+    def __reduce__(self):
+        # the tables are rebuilt in the unpickling process instead of being copied
+        return get_vocabulary, ()
+
+
+@functools.lru_cache(maxsize=None)
+def get_vocabulary() -> Vocabulary:
+    """
+    built once per process
+    """
+    event2word, word2event = encoder_utils.mk_remi_map()
+    event2word = encoder_utils.add_flat_chord2map(event2word)
+    event2word = encoder_utils.abstract_chord_types(event2word)
+
+    kinds = np.full(TOKEN_OFFSET.VOCAB_SIZE.value, EVENT_KIND.NONE, dtype=np.int64)
+    values = np.zeros(TOKEN_OFFSET.VOCAB_SIZE.value, dtype=np.int64)
+    chord_names = []
+    for word, event in word2event.items():
+        name, value = event.split("_")
+        kinds[word] = EVENT_NAME_TO_KIND[name]
+        if name == "Position":
+            values[word] = int(value.split("/")[0]) - 1
+        elif name == "Chord":
+            values[word] = len(chord_names)
+            chord_names.append(value)
+        elif name != "Bar":
+            values[word] = int(value)
+    kinds.setflags(write=False)
+    values.setflags(write=False)
+    return Vocabulary(
+        event2word=MappingProxyType(event2word),
+        word2event=MappingProxyType(word2event),
+        kinds=kinds,
+        values=values,
+        chord_names=tuple(chord_names),
+    )
@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 import copy
-from typing import List
+from typing import BinaryIO, List, Optional
 
 import yaml
 from mido import MidiFile, MidiTrack, merge_tracks, tick2second
@@ -12,8 +12,11 @@ class CommuFile(MidiFile):
 
     channel_count = -1
 
-    def __init__(self, filepath: str, name: str, instrument: str) -> None:
-        super().__init__(filepath)
+    def __init__(
+            self, filepath: Optional[str], name: str, instrument: str, file: Optional[BinaryIO] = None
+    ) -> None:
+        # `file` reads an in-memory midi instead of `filepath`
+        super().__init__(filepath, file=file)
         self._preprocess(name, instrument)
 
     @property
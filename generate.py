@@ -19,8 +19,7 @@ def main(args: argparse.Namespace, timestamp: str) -> None:
             args.num_measures,
             args.genre,
             args.rhythm,
-            args.chord_progression,
-            timestamp)
+            args.chord_progression)
     else:
         role_to_midis = DSET.sample_midis(
             args.bpm,
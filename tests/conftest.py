@@ -0,0 +1,66 @@
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import pytest
+import torch
+import yaml
+
+from commu.midi_generator.container import TransXlInputData
+from commu.midi_generator.info_preprocessor import PreprocessTask
+
+from commu.model.config_helper import get_default_cfg_training
+from commu.model.dataset import BaseVocab
+from commu.model.model import MemTransformerLM
+
+
+def make_model(mem_len: int, seed: int = 0) -> MemTransformerLM:
+    """
+    small random-weight model set up for inference as `ModelInitializeTask` does
+    """
+    cfg = get_default_cfg_training()
+    cfg.defrost()
+    cfg.MODEL.same_length = True
+    cfg.MODEL.num_layers = 2
+    cfg.MODEL.num_heads = 4
+    cfg.MODEL.units = 64
+    cfg.MODEL.inner_size = 128
+    cfg.freeze()
+    torch.manual_seed(seed)
+    model = MemTransformerLM(cfg, BaseVocab())
+    with torch.no_grad():
+        for param in model.parameters():
+            param.normal_(0, 0.05)
+    model.eval()
+    model.reset_length(1, mem_len)
+    return model
+
+
+@pytest.fixture
+def model_factory():
+    return make_model
+
+
+def make_input_data(output_dir: Path, **updates) -> Dict[str, Any]:
+    """
+    inputs of an 8 measure main melody, as given to `PreprocessTask.excecute`
+    """
+    with open(Path(__file__).parents[1] / "cfg" / "chord_progressions.yaml") as f:
+        chord_progression = yaml.safe_load(f)["Am-C-F-G-Am-C-F-G"]
+    input_data = {
+        "track_role": "main_melody", "bpm": 120, "audio_key": "aminor", "time_signature": "4/4",
+        "num_measures": 8, "genre": "newage", "rhythm": "standard",
+        "chord_progression": chord_progression, "pitch_range": "mid", "inst": "acoustic_piano",
+        "min_velocity": 40, "max_velocity": 90, "top_k": 32, "temperature": 0.95,
+        "output_dir": str(output_dir), "num_generate": 1,
+    }
+    input_data.update(updates)
+    return input_data
+
+
+def preprocess(output_dir: Path, **updates) -> Tuple[List[int], TransXlInputData]:
+    """
+    encoded meta and input data of `make_input_data`
+    """
+    preprocess_task = PreprocessTask()
+    encoded_meta = preprocess_task.excecute(make_input_data(output_dir, **updates))
+    return encoded_meta, preprocess_task.input_data
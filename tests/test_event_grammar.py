@@ -0,0 +1,31 @@
+import torch
+
+from commu.midi_generator.midi_inferrer import InferenceTask
+from commu.model.config_helper import get_default_cfg_inference
+from commu.preprocessor.encoder import TOKEN_OFFSET
+from conftest import preprocess
+
+
+def test_grammar_rows_stop_at_eos(model_factory, tmp_path):
+    model = model_factory(4096)
+    # a model keen on bar tokens samples them once every chord is written
+    with torch.no_grad():
+        model.crit.out_layers[0].bias[TOKEN_OFFSET.BAR.value] += 1.5
+    encoded_meta, input_data = preprocess(tmp_path, num_generate=4)
+    inference_cfg = get_default_cfg_inference()
+    inference_cfg.defrost()
+    inference_cfg.GENERATION.generation_length = 1024
+    inference_cfg.freeze()
+    assert inference_cfg.GENERATION.constrain_grammar
+    task = InferenceTask(torch.device("cpu"))
+    task(model=model, input_data=input_data, inference_cfg=inference_cfg)
+
+    torch.manual_seed(0)
+    with torch.no_grad():
+        seqs, mems = task.init_seqs_and_mems([encoded_meta] * 4)
+        sequences = task.generate_sequences(seqs, mems)
+
+    for seq in sequences:
+        assert seq is not None
+        assert seq[-1] == TOKEN_OFFSET.EOS.value
+        assert seq.count(TOKEN_OFFSET.BAR.value) == input_data.num_measures
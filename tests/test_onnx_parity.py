@@ -0,0 +1,118 @@
+import json
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+
+import pytest
+import torch
+
+from commu.midi_generator.midi_inferrer import InferenceTask
+from commu.midi_generator.onnx_runtime import OnnxRuntimeDecoder
+from commu.model.config_helper import get_default_cfg_inference
+from commu.model.onnx_export import compare_onnx_logits, export_onnx
+from commu.preprocessor.encoder import TOKEN_OFFSET
+from conftest import make_input_data, preprocess
+
+pytest.importorskip("onnxruntime")
+pytest.importorskip("onnx")
+
+
+def load_decoder(model, tmp_path):
+    prefill_fp, decode_fp = tmp_path / "model.prefill.onnx", tmp_path / "model.decode.onnx"
+    export_onnx(model, prefill_fp, decode_fp)
+    return OnnxRuntimeDecoder(prefill_fp, decode_fp, model.mem_len)
+
+
+def generate(model, encoded_meta, input_data):
+    inference_cfg = get_default_cfg_inference()
+    inference_cfg.defrost()
+    inference_cfg.GENERATION.generation_length = 200
+    inference_cfg.freeze()
+    task = InferenceTask(torch.device("cpu"))
+    task(model=model, input_data=input_data, inference_cfg=inference_cfg)
+
+    with torch.no_grad():
+        seq, mems = task.init_seq_and_mems(encoded_meta, len(encoded_meta))
+        rows = task.init_rows([seq])
+        for _ in task.iter_decode(rows, mems):
+            pass
+    return rows[0].seq
+
+
+@pytest.mark.parametrize("mem_len", [64, 4096])
+@pytest.mark.parametrize(
+    "prefill_len, chunk_len",
+    [
+        (12, 1),
+        # forced tokens are fed as chunks
+        (12, 5),
+        # rollbacks prefill contexts longer than the memory
+        (100, 1),
+        (100, 3),
+    ],
+)
+def test_onnx_logits_match_torch(model_factory, tmp_path, mem_len, prefill_len, chunk_len):
+    model = model_factory(mem_len)
+    decoder = load_decoder(model, tmp_path)
+    torch.manual_seed(0)
+    sequences = torch.randint(1, 729, (2, 160)).tolist()
+
+    result = compare_onnx_logits(
+        model, decoder, sequences, prefill_len=prefill_len, chunk_len=chunk_len
+    )
+
+    assert result["max_logits_diff"] < 1e-6
+    assert result["argmax_agreement"] == 1.0
+
+
+def test_onnx_generation_matches_torch(model_factory, tmp_path):
+    model = model_factory(64)
+    decoder = load_decoder(model, tmp_path)
+    # the onnxruntime backend samples from np.random, so both backends decode greedily
+    encoded_meta, input_data = preprocess(tmp_path, temperature=0)
+
+    torch_seq = generate(model, encoded_meta, input_data)
+    onnx_seq = generate(decoder, encoded_meta, input_data)
+
+    assert onnx_seq == torch_seq
+    # past the memory window, so the decode graph runs with a full memory
+    assert len(torch_seq) > 64
+
+
+def test_onnxruntime_pipeline_runs_without_torch(model_factory, tmp_path):
+    model = model_factory(get_default_cfg_inference().MODEL.memory_length)
+    # a model keen on bar tokens finishes its sequences quickly
+    with torch.no_grad():
+        model.crit.out_layers[0].bias[TOKEN_OFFSET.BAR.value] += 1.5
+    model_fp = tmp_path / "checkpoint.pt"
+    model_fp.touch()
+    export_onnx(model, tmp_path / "checkpoint.prefill.onnx", tmp_path / "checkpoint.decode.onnx")
+    input_data = make_input_data(tmp_path)
+
+    # importing torch fails in the worker, so nothing on the onnxruntime path may import it
+    script = textwrap.dedent(
+        """
+        import json
+        import sys
+
+        import numpy as np
+
+        sys.modules["torch"] = None
+        from commu.midi_generator.generate_pipeline import MidiGenerationPipeline
+
+        pipeline = MidiGenerationPipeline({"checkpoint_dir": sys.argv[1], "backend": "onnxruntime"})
+        model = pipeline.model_initialize_task.execute()
+        np.random.seed(0)
+        inference_cfg = pipeline.model_initialize_task.inference_cfg
+        role_to_buffer = pipeline.execute_multi_role_in_memory(
+            model, inference_cfg, {"main_melody": json.loads(sys.argv[2])}
+        )
+        assert role_to_buffer["main_melody"].getbuffer().nbytes > 0
+        """
+    )
+    subprocess.run(
+        [sys.executable, "-c", script, str(model_fp), json.dumps(input_data)],
+        cwd=Path(__file__).parents[1],
+        check=True,
+    )
@@ -0,0 +1,19 @@
+import torch
+
+from commu.model.quantization import compare_token_distributions, quantize_dynamic_int8
+
+
+def test_int8_distributions_match_fp32(model_factory):
+    model = model_factory(4096)
+    quantized = quantize_dynamic_int8(model)
+    torch.manual_seed(0)
+    sequences = torch.randint(1, 729, (4, 200)).tolist()
+
+    result = compare_token_distributions(model, quantized, sequences, torch.device("cpu"))
+
+    assert any(
+        isinstance(module, torch.ao.nn.quantized.dynamic.Linear) for module in quantized.modules()
+    )
+    assert result["mean_kl"] < 1e-4
+    assert result["max_prob_diff"] < 1e-3
+    assert result["top1_agreement"] >= 0.9